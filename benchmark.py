@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+from generate_wiki_dump import WikiDumpGenerator
+
+# the indexer and the search engine find the index at ../wiki_index/, so they run from a run/ directory next to it
+repo_dir = os.path.dirname(os.path.abspath(__file__)) + '/'
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_percentiles(latencies):
+    if len(latencies) < 2:
+        latencies = latencies * 2
+    cut_points = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {'p50_ms': cut_points[49] * 1000, 'p95_ms': cut_points[94] * 1000, 'p99_ms': cut_points[98] * 1000}
+
+
+def generate_dump(work_dir, num_pages, seed, num_queries):
+    generator = WikiDumpGenerator(seed)
+    s = time.time()
+    num_pages, dump_bytes = generator.write(work_dir + 'dump.xml.bz2', num_pages)
+    queries = generator.make_queries(num_queries)
+    with open(work_dir + 'queries.txt', 'w', encoding="utf-8") as f:
+        f.write('\n'.join(queries) + '\n')
+    return {'pages': num_pages, 'uncompressed_mb': dump_bytes / 2 ** 20,
+            'compressed_mb': os.path.getsize(work_dir + 'dump.xml.bz2') / 2 ** 20, 'seconds': time.time() - s}
+
+
+def benchmark_indexing(work_dir, dump, indexer_args):
+    shutil.rmtree(work_dir + 'wiki_index', ignore_errors=True)
+    os.makedirs(work_dir + 'run', exist_ok=True)
+    s = time.time()
+    output = subprocess.run([sys.executable, repo_dir + 'english_indexer.py', work_dir + 'dump.xml.bz2'] + indexer_args,
+                            cwd=work_dir + 'run', capture_output=True, text=True)
+    seconds = time.time() - s
+    if output.returncode != 0:
+        sys.exit(f'indexing failed:\n{output.stderr}')
+    # ru_maxrss of the children is in kilobytes on linux. It is the peak of the largest single descendant, not the sum
+    # over a --workers pool
+    max_process_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    timings = dict(re.findall(r'^(Parsed|Merged) in - ([0-9.]+)$', output.stdout, re.M))
+    index_bytes = sum(os.path.getsize(os.path.join(dir_path, file_name))
+                      for dir_path, _, file_names in os.walk(work_dir + 'wiki_index') for file_name in file_names)
+    return {'seconds': seconds, 'pages_per_second': dump['pages'] / seconds,
+            'mb_per_second': dump['uncompressed_mb'] / seconds, 'parse_seconds': float(timings.get('Parsed', 0)),
+            'merge_seconds': float(timings.get('Merged', 0)), 'max_process_rss_mb': max_process_rss_mb,
+            'index_mb': index_bytes / 2 ** 20}
+
+
+def make_run_query(work_dir, ranker_name, use_impacts=True):
+    from english_search import (FileTraverser, NumpyRanker, QueryResults, Ranker, RunQuery, Stemmer,
+                                TextPreProcessor, get_num_pages, get_stop_words, html_tags, read_manifest,
+                                stemmer_language)
+    index_dir = work_dir + 'wiki_index/'
+    manifest = read_manifest(index_dir)
+    num_pages = get_num_pages(index_dir, manifest)
+    field_weights = manifest['field_weights'] if manifest is not None else None
+    file_traverser = FileTraverser(index_dir, use_numpy=ranker_name == 'numpy', use_impacts=use_impacts)
+    if ranker_name == 'numpy':
+        ranker = NumpyRanker(num_pages, field_weights)
+    else:
+        ranker = Ranker(num_pages, ranker_name, field_weights)
+    language = manifest['stemmer_language'] if manifest is not None else stemmer_language
+    # no caches, every query pays for its postings
+    text_pre_processor = TextPreProcessor(html_tags, Stemmer(language), get_stop_words(manifest))
+    return RunQuery(text_pre_processor, file_traverser, ranker, QueryResults(file_traverser))
+
+
+def read_queries(work_dir):
+    with open(work_dir + 'queries.txt', 'r', encoding="utf-8") as f:
+        return [query.strip() for query in f if query.strip()]
+
+
+def benchmark_queries(work_dir, ranker_name, num_results, repeat):
+    run_query = make_run_query(work_dir, ranker_name)
+    queries = read_queries(work_dir)
+    latencies = {'simple': [], 'field': [], 'mixed': []}
+    s = time.time()
+    for _ in range(repeat):
+        for query in queries:
+            q = time.perf_counter()
+            for page_id, _ in run_query.search(query, num_results) or []:
+                run_query.get_title(page_id)
+            latencies[run_query.get_query_key(query, num_results)[0]].append(time.perf_counter() - q)
+    seconds = time.time() - s
+    all_latencies = [latency for query_latencies in latencies.values() for latency in query_latencies]
+    results = {'queries': len(all_latencies), 'seconds': seconds, 'queries_per_second': len(all_latencies) / seconds,
+               'mean_ms': statistics.mean(all_latencies) * 1000, **get_percentiles(all_latencies)}
+    for query_type, query_latencies in latencies.items():
+        if query_latencies:
+            results[query_type] = {'queries': len(query_latencies), **get_percentiles(query_latencies)}
+    return results
+
+
+def benchmark_impact_quality(work_dir, ranker_name, num_results):
+    # the top k from quantized impacts against the top k from exact float scores on the same index
+    impact_query = make_run_query(work_dir, ranker_name)
+    exact_query = make_run_query(work_dir, ranker_name, use_impacts=False)
+    overlaps, same_order = [], 0
+    for query in read_queries(work_dir):
+        key = impact_query.get_query_key(query, num_results)
+        if key[0] == 'field':
+            continue
+        impact_ids = [page_id for page_id, _ in impact_query.search_key(key) or []]
+        exact_ids = [page_id for page_id, _ in exact_query.search_key(key) or []]
+        if exact_ids:
+            overlaps.append(len(set(impact_ids) & set(exact_ids)) / len(exact_ids))
+            same_order += impact_ids == exact_ids
+    return {'queries': len(overlaps), f'mean_overlap_at_{num_results}': statistics.mean(overlaps) if overlaps else None,
+            'same_order_fraction': same_order / len(overlaps) if overlaps else None}
+
+
+def compare_results(baseline, results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict) and isinstance(baseline.get(key), dict):
+            compare_results(baseline[key], value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and isinstance(baseline.get(key), (int, float)) and baseline[key]:
+            print(f'{prefix}{key}: {baseline[key]:.4g} -> {value:.4g} ({(value / baseline[key] - 1) * 100:+.1f}%)')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--pages', action='store', default=10000, type=int)
+    arg_parser.add_argument('--seed', action='store', default=1, type=int)
+    arg_parser.add_argument('--work-dir', action='store', default='../benchmark/', type=str)
+    arg_parser.add_argument('--output', action='store', default='benchmark_results.json', type=str)
+    arg_parser.add_argument('--compare', action='store', type=str)
+    arg_parser.add_argument('--workers', action='store', default=0, type=int)
+    arg_parser.add_argument('--index-format', action='store', default='binary', choices=['text', 'binary'])
+    arg_parser.add_argument('--ranker', action='store', default='exhaustive', choices=['exhaustive', 'maxscore', 'numpy'])
+    arg_parser.add_argument('--num-queries', action='store', default=500, type=int)
+    arg_parser.add_argument('--num_results', action='store', default=10, type=int)
+    arg_parser.add_argument('--repeat', action='store', default=1, type=int)
+    arg_parser.add_argument('--skip-indexing', action='store_true')
+    arg_parser.add_argument('--impacts', action='store_true')
+    args = arg_parser.parse_args()
+    work_dir = os.path.abspath(args.work_dir) + '/'
+    os.makedirs(work_dir, exist_ok=True)
+    results = {'config': vars(args), 'git_commit': get_git_commit(), 'python': platform.python_version(),
+               'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+    if args.skip_indexing:
+        # reuses the dump, queries and index of an earlier run in the same work dir
+        with open(work_dir + 'dump.json', 'r') as f:
+            results['dump'] = json.load(f)
+    else:
+        print(f'Generating {args.pages} pages')
+        results['dump'] = generate_dump(work_dir, args.pages, args.seed, args.num_queries)
+        with open(work_dir + 'dump.json', 'w') as f:
+            json.dump(results['dump'], f)
+        print('Indexing')
+        results['indexing'] = benchmark_indexing(work_dir, results['dump'],
+                                                 ['--workers', str(args.workers), '--index-format', args.index_format]
+                                                 + (['--impacts'] if args.impacts else []))
+    print('Querying')
+    results['querying'] = benchmark_queries(work_dir, args.ranker, args.num_results, args.repeat)
+    if args.impacts:
+        # field queries are scored exactly either way, only simple and mixed queries are compared
+        results['impact_quality'] = benchmark_impact_quality(work_dir, args.ranker, args.num_results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({key: results[key] for key in ['dump', 'indexing', 'querying', 'impact_quality']
+                      if key in results}, indent=2))
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_results(json.load(f), results)
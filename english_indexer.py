@@ -1,68 +1,56 @@
+import argparse
+import bz2
+import fcntl
+import heapq
+import linecache
+import math
+import multiprocessing
 import os
+import queue
 import re
-import sys
+import shutil
+import threading
 import time
 import xml.sax
+from array import array
 from bz2 import BZ2File
-from collections import defaultdict
+from bisect import bisect_right
+from collections import defaultdict, deque
+from itertools import islice
 
 from Stemmer import Stemmer
 from nltk.corpus import stopwords
 from tqdm import tqdm
 
-index_map = defaultdict(str)
+from index_format import (FIELD_WEIGHTS, FIELDS, POSTINGS_HEADER, POSTINGS_VERSION, RETIRED_SEGMENTS_FILE,
+                          SEGMENT_LOCK_FILE, SHARDS_FILE, TermDictionary, TermDictionaryWriter, TitleStore,
+                          TitleStoreWriter, decode_postings, encode_impacts, encode_postings, is_deleted,
+                          open_postings_file, parse_size, read_impact_offsets, read_manifest, read_segments,
+                          read_tombstones, write_impact_offsets, write_manifest, write_segments, write_title_prefixes,
+                          write_tombstones)
+from metrics import TimedReader, metrics
+from text_processing import TextPreProcessor, html_tags, stemmer_language
+
+index_dir = '../wiki_index/'
 num_files = 0
 num_pages = 0
 id_title_map = {}
-
-
-# https://medium.com/analytics-vidhya/search-engine-in-python-from-scratch-c3f7cc453250
-class TextPreProcessor:
-    def __init__(self, html_tags, stemmer, stop_words):
-        self.html_tags = html_tags
-        self.stemmer = stemmer
-        self.stop_words = stop_words
-
-    def remove_stopwords(self, text_data):
-        cleaned_text = [word for word in text_data if word not in self.stop_words]
-        return cleaned_text
-
-    def stem_text(self, text_data):
-        cleaned_text = self.stemmer.stemWords(text_data)
-        return cleaned_text
-
-    def remove_non_ascii(self, text_data):
-        cleaned_text = ''.join([i if ord(i) < 128 else ' ' for i in text_data])
-        return cleaned_text
-
-    def remove_html_tags(self, text_data):
-        cleaned_text = re.sub(self.html_tags, ' ', text_data)
-        return cleaned_text
-
-    def remove_special_chars(self, text_data):
-        cleaned_text = ''.join(ch if ch.isalnum() else ' ' for ch in text_data)
-        return cleaned_text
-
-    def remove_keywords(self, text_data):
-        text_data = text_data.replace('\n', ' ').replace('File:', ' ')
-        text_data = re.sub('(http://[^ ]+)', ' ', text_data)
-        text_data = re.sub('(https://[^ ]+)', ' ', text_data)
-        return text_data
-
-    def tokenize_sentence(self, text_data, flag=False):
-        if flag:
-            text_data = self.remove_keywords(text_data)
-            text_data = re.sub('\{.*?\}|\[.*?\]|\=\=.*?\=\=', ' ', text_data)
-        cleaned_text = self.remove_non_ascii(text_data)
-        cleaned_text = self.remove_html_tags(cleaned_text)
-        cleaned_text = self.remove_special_chars(cleaned_text)
-        return cleaned_text.split()
-
-    def preprocess_text(self, text_data, flag=False):
-        cleaned_data = self.tokenize_sentence(text_data.lower(), flag)
-        cleaned_data = self.remove_stopwords(cleaned_data)
-        cleaned_data = self.stem_text(cleaned_data)
-        return cleaned_data
+worker_page_processor = None
+repeated_chars = re.compile(r'(.)\1\1\1')
+star_lines = re.compile(r'^\*.*', re.M)
+http_words = re.compile('(?<![^ ])[^ ]*http[^ ]*')
+# id:t1b2; postings of a merged posting list and the field frequencies in them
+posting_fields = re.compile('([0-9]+):([^;]*);')
+field_freqs_pattern = re.compile('([tbcilr])([0-9]+)')
+field_positions = {field_char: i for i, field_char in enumerate('tbcilr')}
+field_char_weights = {field_char: FIELD_WEIGHTS[field] for field_char, field in zip('tbcilr', FIELDS)}
+# a page's posting of a word is a field mask, with bit 0 for t up to bit 5 for r, and the nonzero field frequencies.
+# The format string of a mask writes id:t1b2...; from the doc id and the frequencies
+posting_formats = ['{}:' + ''.join(char + '{}' for bit, char in enumerate('tbcilr') if mask >> bit & 1) + ';'
+                   for mask in range(64)]
+# rough CPython costs of a term's dict slot, key and array object, and of a title in id_title_map
+term_overhead = 200
+title_overhead = 150
 
 
 class PageProcessor:
@@ -73,295 +61,504 @@ class PageProcessor:
         cleaned_title = self.text_pre_processor.preprocess_text(title)
         return cleaned_title
 
-    def process_infobox(self, text):
-        cleaned_infobox = []
-        try:
-            text = text.split('\n')
-            i = 0
-            while '{{Infobox' not in text[i]:
-                i += 1
-            data = []
-            data.append(text[i].replace('{{Infobox', ' '))
-            i += 1
-            while text[i] != '}}':
-                if '{{Infobox' in text[i]:
-                    dt = text[i].replace('{{Infobox', ' ')
-                    data.append(dt)
-                else:
-                    data.append(text[i])
-                i += 1
-            infobox_data = ' '.join(data)
-            cleaned_infobox = self.text_pre_processor.preprocess_text(infobox_data)
-        except:
-            pass
-        return cleaned_infobox
-
     def process_text_body(self, text):
-        cleaned_text_body = text_pre_processor.preprocess_text(text, True)
+        cleaned_text_body = self.text_pre_processor.preprocess_text(text, True)
         return cleaned_text_body
 
-    def process_category(self, text):
-        cleaned_category = []
-        try:
-            text = text.split('\n')
-            i = 0
-            while not text[i].startswith('[[Category:'):
-                i += 1
-            data = []
-            data.append(text[i].replace('[[Category:', ' ').replace(']]', ' '))
-            i += 1
-            while text[i].endswith(']]'):
-                dt = text[i].replace('[[Category:', ' ').replace(']]', ' ')
-                data.append(dt)
-                i += 1
-            category_data = ' '.join(data)
-            cleaned_category = self.text_pre_processor.preprocess_text(category_data)
-        except:
-            pass
-        return cleaned_category
-
-    def process_links(self, text):
-        cleaned_links = []
-        try:
-            links = ''
-            text = text.split("==External links==")
-            if len(text) > 1:
-                text = text[1].split("\n")[1:]
-                for txt in text:
-                    if txt == '':
-                        break
-                    if txt[0] == '*':
-                        text_split = txt.split(' ')
-                        link = [wd for wd in text_split if 'http' not in wd]
-                        link = ' '.join(link)
-                        links += ' ' + link
-            cleaned_links = self.text_pre_processor.preprocess_text(links)
-        except:
-            pass
-        return cleaned_links
-
-    def process_references(self, text):
-        cleaned_references = []
-        try:
-            references = ''
-            text = text.split('==References==')
-            if len(text) > 1:
-                text = text[1].split("\n")[1:]
-                for txt in text:
-                    if txt == '':
-                        break
-                    if txt[0] == '*':
-                        text_split = txt.split(' ')
-                        reference = [wd for wd in text_split if 'http' not in wd]
-                        reference = ' '.join(reference)
-                        references += ' ' + reference
-            cleaned_references = self.text_pre_processor.preprocess_text(references)
-        except:
-            pass
-        return cleaned_references
+    def extract_fields(self, text):
+        # Each field is read from the line of its marker, which str.find locates without splitting or walking the
+        # lines before it
+        return (self.extract_infobox(text), self.extract_category(text), self.extract_section(text, '==External links=='),
+                self.extract_section(text, '==References=='))
+
+    def extract_infobox(self, text):
+        # the first line with {{Infobox up to a line that is exactly }}. An infobox that is never closed is dropped,
+        # the rest of the page is not infobox text
+        pos = text.find('{{Infobox')
+        if pos < 0:
+            return ''
+        start = text.rfind('\n', 0, pos) + 1
+        end = text.find('\n', pos)
+        if end < 0:
+            return ''
+        close = text.find('\n}}\n', end)
+        if close < 0:
+            if not text.endswith('\n}}') or len(text) - 3 < end:
+                return ''
+            close = len(text) - 3
+        return text[start:close].replace('{{Infobox', ' ').replace('\n', ' ')
+
+    def extract_category(self, text):
+        # the first line starting with [[Category: and the lines ending in ]] right after it, which usually run to
+        # the end of the page
+        if text.startswith('[[Category:'):
+            start = 0
+        else:
+            start = text.find('\n[[Category:') + 1
+            if start == 0:
+                return ''
+        lines = text[start:].split('\n')
+        data = [lines[0].replace('[[Category:', ' ').replace(']]', ' ')]
+        for line in islice(lines, 1, None):
+            if not line.endswith(']]'):
+                break
+            data.append(line.replace('[[Category:', ' ').replace(']]', ' '))
+        return ' '.join(data)
+
+    def extract_section(self, text, heading):
+        # the * lines after the first copy of the heading, up to an empty line or the next copy of the heading,
+        # without the space separated words that contain http
+        pos = text.find(heading) + len(heading)
+        if pos < len(heading):
+            return ''
+        end = text.find(heading, pos)
+        if end < 0:
+            end = len(text)
+        # the rest of the heading line is skipped
+        start = text.find('\n', pos, end) + 1
+        if start == 0:
+            return ''
+        section = text[start:end]
+        blank = ('\n' + section + '\n').find('\n\n')
+        if blank >= 0:
+            section = section[:blank]
+        return http_words.sub('', ''.join(' ' + line for line in star_lines.findall(section)))
 
     def process_page(self, title, text):
-        title = self.process_title(title)
-        body = self.process_text_body(text)
-        category = self.process_category(text)
-        infobox = self.process_infobox(text)
-        link = self.process_links(text)
-        reference = self.process_references(text)
+        with metrics.timer('index.process_title'):
+            title = self.process_title(title)
+        with metrics.timer('index.process_body'):
+            body = self.process_text_body(text)
+        with metrics.timer('index.extract_fields'):
+            fields = self.extract_fields(text)
+        with metrics.timer('index.process_fields'):
+            infobox, category, link, reference = [self.text_pre_processor.preprocess_text(field) if field else []
+                                                  for field in fields]
         return title, body, category, infobox, link, reference
 
 
 class WriteData():
-    def __init__(self):
-        pass
+    def __init__(self, index_format='text', output_dir=None):
+        self.index_format = index_format
+        # final files go to output_dir, intermediate runs always to index_dir
+        self.index_dir = output_dir if output_dir is not None else index_dir
+        self.term_dictionary = None
+        self.title_store = None
+        # the number of pages idfs are taken from, set before merging when impact lists are wanted
+        self.impact_pages = None
+        self.impact_offsets = array('Q')
 
-    def write_id_title_map(self):
-        global id_title_map
+    def write_id_title_map(self, id_title_map):
+        with metrics.timer('index.flush_titles'):
+            self.write_id_title_map_file(id_title_map)
+
+    def write_id_title_map_file(self, id_title_map):
         temp_id_title = []
         temp_id_title_map = sorted(id_title_map.items(), key=lambda item: int(item[0]))
         for id, title in tqdm(temp_id_title_map):
             t = str(id) + '-' + title.strip()
             temp_id_title.append(t)
-        with open('../wiki_index/id_title_map.txt', 'a', encoding="utf-8") as f:
+        with open(self.index_dir + 'id_title_map.txt', 'a', encoding="utf-8") as f:
             f.write('\n'.join(temp_id_title))
             f.write('\n')
+        # ids are contiguous across flushes, so the title store can be appended to chunk by chunk
+        if self.title_store is None:
+            self.title_store = TitleStoreWriter(self.index_dir + 'id_title_offsets.bin',
+                                                self.index_dir + 'id_title_blob.bin')
+        self.title_store.add([title.strip() for _, title in temp_id_title_map])
+
+    def write_intermed_index(self, postings):
+        with metrics.timer('index.flush_postings'):
+            self.write_intermed_index_file(postings)
+        metrics.count('index.flushes')
 
-    def write_intermed_index(self):
+    def write_intermed_index_file(self, postings):
         global num_files
-        global index_map
-        temp_index_map = sorted(index_map.items(), key=lambda item: item[0])
         temp_index = []
-        for word, posting in tqdm(temp_index_map):
+        for word, posting in tqdm(postings.get_sorted_postings()):
             temp_index.append(word + '-' + posting)
-        with open(f'../wiki_index/index_{num_files}.txt', 'w', encoding="utf-8") as f:
+        with open(f'{index_dir}index_{num_files}.txt', 'w', encoding="utf-8") as f:
             f.write('\n'.join(temp_index))
         num_files += 1
 
     def write_final_files(self, data_to_merge, num_files_final):
-        title_dict, body_dict, category_dict, infobox_dict, link_dict, reference_dict = defaultdict(dict), defaultdict(
-            dict), defaultdict(dict), defaultdict(dict), defaultdict(dict), defaultdict(dict)
-        unique_tokens_info = {}
-        sorted_data = sorted(data_to_merge.items(), key=lambda item: item[0])
-        for i, (token, postings) in tqdm(enumerate(sorted_data)):
-            for posting in postings.split(';')[:-1]:
-                id = posting.split(':')[0]
-                fields = posting.split(':')[1]
-                if 't' in fields:
-                    title_dict[token][id] = re.search(r'.*t([0-9]*).*', fields).group(1)
-                if 'b' in fields:
-                    body_dict[token][id] = re.search(r'.*b([0-9]*).*', fields).group(1)
-                if 'c' in fields:
-                    category_dict[token][id] = re.search(r'.*c([0-9]*).*', fields).group(1)
-                if 'i' in fields:
-                    infobox_dict[token][id] = re.search(r'.*i([0-9]*).*', fields).group(1)
-                if 'l' in fields:
-                    link_dict[token][id] = re.search(r'.*l([0-9]*).*', fields).group(1)
-                if 'r' in fields:
-                    reference_dict[token][id] = re.search(r'.*r([0-9]*).*', fields).group(1)
-            token_info = '-'.join([token, str(num_files_final), str(len(postings.split(';')[:-1]))])
-            unique_tokens_info[token] = token_info + '-'
-        final_titles, final_body_texts, final_categories, final_infoboxes, final_links, final_references = [], [], [], [], [], []
-        for i, (token, _) in tqdm(enumerate(sorted_data)):
-            if token in title_dict.keys():
-                posting = title_dict[token]
-                final_titles = self.get_diff_postings(token, posting, final_titles)
-                t = len(final_titles)
-                unique_tokens_info[token] += str(t) + '-'
-            else:
-                unique_tokens_info[token] += '-'
-            if token in body_dict.keys():
-                posting = body_dict[token]
-                final_body_texts = self.get_diff_postings(token, posting, final_body_texts)
-                t = len(final_body_texts)
-                unique_tokens_info[token] += str(t) + '-'
-            else:
-                unique_tokens_info[token] += '-'
-            if token in category_dict.keys():
-                posting = category_dict[token]
-                final_categories = self.get_diff_postings(token, posting, final_categories)
-                t = len(final_categories)
-                unique_tokens_info[token] += str(t) + '-'
-            else:
-                unique_tokens_info[token] += '-'
-            if token in infobox_dict.keys():
-                posting = infobox_dict[token]
-                final_infoboxes = self.get_diff_postings(token, posting, final_infoboxes)
-                t = len(final_infoboxes)
-                unique_tokens_info[token] += str(t) + '-'
-            else:
-                unique_tokens_info[token] += '-'
-            if token in link_dict.keys():
-                posting = link_dict[token]
-                final_links = self.get_diff_postings(token, posting, final_links)
-                t = len(final_links)
-                unique_tokens_info[token] += str(t) + '-'
-            else:
-                unique_tokens_info[token] += '-'
-            if token in reference_dict.keys():
-                posting = reference_dict[token]
-                final_references = self.get_diff_postings(token, posting, final_references)
-                t = len(final_references)
-                unique_tokens_info[token] += str(t) + '-'
-            else:
-                unique_tokens_info[token] += '-'
-        with open('../wiki_index/tokens_info.txt', 'a', encoding="utf-8") as f:
-            f.write('\n'.join(unique_tokens_info.values()))
+        # merged postings are already in doc id order, so each posting list is parsed once and its field lines go
+        # straight to the files
+        if self.term_dictionary is None:
+            self.term_dictionary = TermDictionaryWriter(self.index_dir + 'tokens_dict.bin')
+        binary = self.index_format == 'binary'
+        extension = 'bin' if binary else 'txt'
+        field_files = []
+        for field in FIELDS:
+            file_name = f'{self.index_dir}{field}_data_{num_files_final}.{extension}'
+            field_files.append(open(file_name, 'wb') if binary else open(file_name, 'w', encoding="utf-8"))
+        # text files point at a line number, binary files at the byte offset of the posting list
+        if binary:
+            for f in field_files:
+                f.write(POSTINGS_HEADER)
+        field_sizes = [len(POSTINGS_HEADER) if binary else 0] * len(FIELDS)
+        impacts = self.impact_pages is not None
+        if impacts:
+            field_files.append(open(f'{self.index_dir}impact_data_{num_files_final}.bin', 'wb'))
+            field_files[-1].write(POSTINGS_HEADER)
+            impact_size = len(POSTINGS_HEADER)
+        tokens_info = []
+        try:
+            for token, postings in tqdm(sorted(data_to_merge.items(), key=lambda item: item[0])):
+                field_ids = [[] for _ in FIELDS]
+                field_freqs = [[] for _ in FIELDS]
+                page_ids, page_weights = [], []
+                num_postings = 0
+                for id, fields in posting_fields.findall(postings):
+                    num_postings += 1
+                    field_postings = field_freqs_pattern.findall(fields)
+                    for field_char, freq in field_postings:
+                        field_ids[field_positions[field_char]].append(id)
+                        field_freqs[field_positions[field_char]].append(freq)
+                    if impacts:
+                        page_ids.append(int(id))
+                        page_weights.append(sum(field_char_weights[field_char] * (1 + math.log(int(freq)))
+                                                for field_char, freq in field_postings))
+                token_info = [token, str(num_files_final), str(num_postings)]
+                pointers, counts = [], []
+                for i, (ids, freqs) in enumerate(zip(field_ids, field_freqs)):
+                    if not ids:
+                        token_info.append('')
+                        pointers.append(0)
+                        counts.append(0)
+                        continue
+                    if binary:
+                        pointer = field_sizes[i]
+                        data = encode_postings(list(map(int, ids)), list(map(int, freqs)))
+                        field_files[i].write(data)
+                        field_sizes[i] += len(data)
+                    else:
+                        field_sizes[i] += 1
+                        pointer = field_sizes[i]
+                        line = token + '-' + ';'.join(id + ':' + freq for id, freq in zip(ids, freqs))
+                        field_files[i].write(line if pointer == 1 else '\n' + line)
+                    token_info.append(str(pointer))
+                    pointers.append(pointer)
+                    counts.append(len(ids))
+                tokens_info.append('-'.join(token_info) + '-')
+                self.term_dictionary.add(token, num_files_final, num_postings, pointers, counts)
+                if impacts:
+                    # simple queries take a token's df from its last field with postings, tokens in every page have
+                    # no idf and no impact list
+                    df = [count for count in counts if count][-1]
+                    if df < self.impact_pages:
+                        idf = math.log((self.impact_pages - df) / df)
+                        data = encode_impacts(page_ids, [weight * idf for weight in page_weights])
+                        self.impact_offsets.append(impact_size)
+                        field_files[-1].write(data)
+                        impact_size += len(data)
+                    else:
+                        self.impact_offsets.append(0)
+        finally:
+            for f in field_files:
+                f.close()
+        with open(self.index_dir + 'tokens_info.txt', 'a', encoding="utf-8") as f:
+            f.write('\n'.join(tokens_info))
             f.write('\n')
-        self.write_diff_postings('title', final_titles, num_files_final)
-        self.write_diff_postings('body', final_body_texts, num_files_final)
-        self.write_diff_postings('category', final_categories, num_files_final)
-        self.write_diff_postings('infobox', final_infoboxes, num_files_final)
-        self.write_diff_postings('link', final_links, num_files_final)
-        self.write_diff_postings('reference', final_references, num_files_final)
         num_files_final += 1
         return num_files_final
 
-    def get_diff_postings(self, token, postings, final_tag):
-        postings = sorted(postings.items(), key=lambda item: int(item[0]))
-        final_posting = token + '-'
-        for id, freq in postings:
-            final_posting += str(id) + ':' + freq + ';'
-        final_tag.append(final_posting.rstrip(';'))
-        return final_tag
+    def add_range_files(self, range_dir, num_range_files, file_base):
+        # final files of a key range written by a merge worker, renumbered to follow the files written so far
+        extension = 'bin' if self.index_format == 'binary' else 'txt'
+        for i in range(num_range_files):
+            for field in FIELDS + (['impact'] if self.impact_pages is not None else []):
+                os.replace(f'{range_dir}{field}_data_{i}.{extension}',
+                           f'{self.index_dir}{field}_data_{file_base + i}.{extension}')
+        if self.impact_pages is not None:
+            self.impact_offsets.extend(read_impact_offsets(range_dir + 'impact_offsets.bin'))
+        with open(range_dir + 'tokens_info.txt', 'r', encoding="utf-8") as f, \
+                open(self.index_dir + 'tokens_info.txt', 'a', encoding="utf-8") as t:
+            for line in f:
+                if line.strip():
+                    token, file_num, token_info = line.split('-', 2)
+                    t.write(f'{token}-{int(file_num) + file_base}-{token_info}')
+        if self.term_dictionary is None:
+            self.term_dictionary = TermDictionaryWriter(self.index_dir + 'tokens_dict.bin')
+        for token, (file_num, freq, pointers, counts) in TermDictionary(range_dir + 'tokens_dict.bin').items():
+            self.term_dictionary.add(token, file_num + file_base, freq, pointers, counts)
+
+    def close(self):
+        if self.term_dictionary is not None:
+            self.term_dictionary.close()
+        if self.title_store is not None:
+            self.title_store.close()
+        if self.impact_pages is not None:
+            write_impact_offsets(self.index_dir + 'impact_offsets.bin', self.impact_offsets)
+
+
+class ShardedWriteData():
+    def __init__(self, index_format, index_root, shards):
+        self.index_root = index_root
+        self.shard_bases = [base for _, base, _ in shards]
+        self.shard_write_data = [WriteData(index_format, f'{index_root}{name}/') for name, _, _ in shards]
+        self.term_dictionary = None
+
+    def write_final_files(self, data_to_merge, num_files_final):
+        # postings are split by doc id range, the root dictionary keeps the global counts every shard scores with
+        if self.term_dictionary is None:
+            self.term_dictionary = TermDictionaryWriter(self.index_root + 'tokens_dict.bin')
+        shard_data = [defaultdict(str) for _ in self.shard_write_data]
+        for token, postings in sorted(data_to_merge.items(), key=lambda item: item[0]):
+            counts = [0] * len(FIELDS)
+            num_postings = 0
+            for posting in postings.split(';')[:-1]:
+                id, fields = posting.split(':')
+                shard_data[bisect_right(self.shard_bases, int(id)) - 1][token] += posting + ';'
+                for i, field_char in enumerate('tbcilr'):
+                    if field_char in fields:
+                        counts[i] += 1
+                num_postings += 1
+            self.term_dictionary.add(token, 0, num_postings, [0] * len(FIELDS), counts)
+        for write_data, data in zip(self.shard_write_data, shard_data):
+            write_data.write_final_files(data, num_files_final)
+        return num_files_final + 1
+
+    def close(self):
+        if self.term_dictionary is not None:
+            self.term_dictionary.close()
+        for write_data in self.shard_write_data:
+            write_data.close()
+
+
+def get_word_postings(title, body, category, infobox, link, reference):
+    words_set, title_dict, body_dict, category_dict, infobox_dict, link_dict, reference_dict = set(), defaultdict(
+        int), defaultdict(int), defaultdict(int), defaultdict(int), defaultdict(int), defaultdict(int)
+    words_set.update(title)
+    for word in title:
+        title_dict[word] += 1
+    words_set.update(body)
+    for word in body:
+        body_dict[word] += 1
+    words_set.update(category)
+    for word in category:
+        category_dict[word] += 1
+    words_set.update(infobox)
+    for word in infobox:
+        infobox_dict[word] += 1
+    words_set.update(link)
+    for word in link:
+        link_dict[word] += 1
+    words_set.update(reference)
+    for word in reference:
+        reference_dict[word] += 1
+    word_postings = {}
+    field_dicts = (title_dict, body_dict, category_dict, infobox_dict, link_dict, reference_dict)
+    for word in words_set:
+        # the old ^((.)(?!\2\2\2))+$ check came down to dropping one-character words and words with a character
+        # repeated four times in a row
+        if len(word) > 1 and not repeated_chars.search(word):
+            mask = 0
+            freqs = []
+            for bit, field_dict in enumerate(field_dicts):
+                if field_dict[word]:
+                    mask |= 1 << bit
+                    freqs.append(field_dict[word])
+            word_postings[word] = (mask, tuple(freqs))
+    return word_postings
+
+
+class PostingAccumulator():
+    def __init__(self):
+        # per term, an array of doc ids each followed by its nonzero field frequencies and a bytearray of the field
+        # masks. Appending does not copy the term's earlier postings the way string concatenation did
+        self.postings = {}
+        self.num_bytes = 0
+
+    def add(self, page_id, word_postings):
+        for word, (mask, freqs) in word_postings.items():
+            term_postings = self.postings.get(word)
+            if term_postings is None:
+                term_postings = self.postings[word] = (array('I'), bytearray())
+                self.num_bytes += term_overhead + len(word)
+            values, masks = term_postings
+            values.append(page_id)
+            values.extend(freqs)
+            masks.append(mask)
+            self.num_bytes += values.itemsize * (len(freqs) + 1) + 1
 
-    def write_diff_postings(self, tag_type, final_tag, num_files_final):
-        with open(f'../wiki_index/{tag_type}_data_{str(num_files_final)}.txt', 'w',
-                  encoding="utf-8") as f:
-            f.write('\n'.join(final_tag))
+    def get_sorted_postings(self):
+        for word in sorted(self.postings):
+            values, masks = self.postings[word]
+            yield word, ''.join(map(posting_formats.__getitem__, masks)).format(*values)
+
+
+class FlushWriter():
+    def __init__(self, write_data, max_pending):
+        # frozen accumulators and title maps are written by one thread in order, so run numbers and title ids
+        # come out the same as with synchronous flushes. put blocks once max_pending snapshots are waiting
+        self.write_data = write_data
+        self.snapshots = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_snapshots, daemon=True)
+        self.thread.start()
+
+    def write_snapshots(self):
+        while True:
+            snapshot = self.snapshots.get()
+            if snapshot is None:
+                return
+            # after a failure the remaining snapshots are only drained, so the parser never blocks on a dead writer
+            if self.error is None:
+                try:
+                    postings, id_title_map = snapshot
+                    self.write_data.write_intermed_index(postings)
+                    self.write_data.write_id_title_map(id_title_map)
+                except BaseException as e:
+                    self.error = e
+
+    def add(self, postings, id_title_map):
+        self.check_error()
+        with metrics.timer('index.flush_wait'):
+            self.snapshots.put((postings, id_title_map))
+
+    def finish(self):
+        self.snapshots.put(None)
+        self.thread.join()
+        self.check_error()
+
+    def check_error(self):
+        if self.error is not None:
+            raise RuntimeError('writing an intermediate run failed') from self.error
 
 
 class CreateIndex():
-    def __init__(self, write_data):
+    def __init__(self, write_data, mem_budget=1 << 30, max_pending_flushes=2):
         self.write_data = write_data
+        # with no pending flushes allowed, runs are written synchronously by the parsing thread
+        self.flush_writer = FlushWriter(write_data, max_pending_flushes) if max_pending_flushes > 0 else None
+        # the live buffer, the pending snapshots, the one being written and the one waiting to be queued can all be
+        # resident at once, the budget is split between them
+        self.spill_bytes = mem_budget // (max_pending_flushes + 2) if self.flush_writer is not None else mem_budget
+        self.postings = PostingAccumulator()
+        self.title_bytes = 0
 
     def index(self, title, body, category, infobox, link, reference):
+        with metrics.timer('index.word_postings'):
+            word_postings = get_word_postings(title, body, category, infobox, link, reference)
+        self.add_postings(num_pages, word_postings)
+
+    def add_page(self, page_id, title, word_postings):
+        id_title_map[page_id] = title
+        self.add_postings(page_id, word_postings)
+
+    def add_postings(self, page_id, word_postings):
         global num_pages
-        global index_map
-        global id_title_map
-        words_set, title_dict, body_dict, category_dict, infobox_dict, link_dict, reference_dict = set(), defaultdict(
-            int), defaultdict(int), defaultdict(int), defaultdict(int), defaultdict(int), defaultdict(int)
-        words_set.update(title)
-        for word in title:
-            title_dict[word] += 1
-        words_set.update(body)
-        for word in body:
-            body_dict[word] += 1
-        words_set.update(category)
-        for word in category:
-            category_dict[word] += 1
-        words_set.update(infobox)
-        for word in infobox:
-            infobox_dict[word] += 1
-        words_set.update(link)
-        for word in link:
-            link_dict[word] += 1
-        words_set.update(reference)
-        for word in reference:
-            reference_dict[word] += 1
-        for word in words_set:
-            temp = re.sub(r'^((.)(?!\2\2\2))+$', r'\1', word)
-            is_rep = len(temp) == len(word)
-            if not is_rep:
-                posting = str(num_pages) + ':'
-                if title_dict[word]:
-                    posting += 't' + str(title_dict[word])
-                if body_dict[word]:
-                    posting += 'b' + str(body_dict[word])
-                if category_dict[word]:
-                    posting += 'c' + str(category_dict[word])
-                if infobox_dict[word]:
-                    posting += 'i' + str(infobox_dict[word])
-                if link_dict[word]:
-                    posting += 'l' + str(link_dict[word])
-                if reference_dict[word]:
-                    posting += 'r' + str(reference_dict[word])
-                posting += ';'
-                index_map[word] += posting
+        if num_pages % 100 == 0:
+            print(num_pages)
+        with metrics.timer('index.add_postings'):
+            self.postings.add(page_id, word_postings)
+        metrics.count('index.pages')
+        metrics.count('index.page_tokens', len(word_postings))
         num_pages += 1
-        if not num_pages % 40000:
-            self.write_data.write_intermed_index()
-            self.write_data.write_id_title_map()
-            index_map = defaultdict(str)
-            id_title_map = {}
+        self.title_bytes += title_overhead + len(id_title_map[page_id])
+        # a run is spilled once the buffered postings and titles reach their share of the budget, whatever the
+        # number of pages
+        if self.postings.num_bytes + self.title_bytes >= self.spill_bytes:
+            self.flush()
+
+    def flush(self):
+        global id_title_map
+        if self.flush_writer is not None:
+            self.flush_writer.add(self.postings, id_title_map)
+        else:
+            self.write_data.write_intermed_index(self.postings)
+            self.write_data.write_id_title_map(id_title_map)
+        # fresh objects, the flushed ones are not touched again by the parser
+        self.postings = PostingAccumulator()
+        self.title_bytes = 0
+        id_title_map = {}
+
+    def finish(self):
+        self.flush()
+        if self.flush_writer is not None:
+            self.flush_writer.finish()
+
+
+# Pool workers build their own pre-processor, Stemmer objects cannot be pickled
+def init_page_worker(html_tags, stop_words, metrics_enabled=False):
+    global worker_page_processor
+    worker_page_processor = PageProcessor(TextPreProcessor(html_tags, Stemmer(stemmer_language), stop_words))
+    metrics.reset()
+    metrics.enabled = metrics_enabled
+
+
+def process_page_batch(pages):
+    processed_pages = []
+    for page_id, title, text in pages:
+        fields = worker_page_processor.process_page(title, text)
+        with metrics.timer('index.word_postings'):
+            word_postings = get_word_postings(*fields)
+        processed_pages.append((page_id, title.lower(), word_postings))
+    # worker timings travel back with the batch and are added to the parent's totals
+    return processed_pages, metrics.take() if metrics.enabled else None
+
+
+class PagePool():
+    def __init__(self, num_workers, create_index, html_tags, stop_words, batch_size=100):
+        self.create_index = create_index
+        self.batch_size = batch_size
+        self.max_pending = 2 * num_workers
+        self.pool = multiprocessing.Pool(num_workers, initializer=init_page_worker,
+                                         initargs=(html_tags, stop_words, metrics.enabled))
+        self.pending = deque()
+        self.batch = []
+        self.next_page_id = num_pages
+
+    def add_page(self, title, text):
+        self.batch.append((self.next_page_id, title, text))
+        self.next_page_id += 1
+        if len(self.batch) == self.batch_size:
+            self.submit_batch()
+
+    def submit_batch(self):
+        if self.batch:
+            self.pending.append(self.pool.apply_async(process_page_batch, (self.batch,)))
+            self.batch = []
+        while len(self.pending) > self.max_pending:
+            self.merge_batch(self.pending.popleft().get())
+
+    def merge_batch(self, batch_result):
+        processed_pages, worker_metrics = batch_result
+        if worker_metrics is not None:
+            metrics.merge(worker_metrics)
+        # batches are merged in submission order so doc ids match the sequential run
+        for page_id, title, word_postings in processed_pages:
+            self.create_index.add_page(page_id, title, word_postings)
+
+    def finish(self):
+        self.submit_batch()
+        while self.pending:
+            self.merge_batch(self.pending.popleft().get())
+        self.pool.close()
+        self.pool.join()
 
 
 class XMLParser(xml.sax.ContentHandler):
-    def __init__(self, page_processor, create_index):
+    def __init__(self, page_processor, create_index, page_pool=None):
         self.tag = ''
         self.title = ''
         self.text = ''
         self.page_processor = page_processor
         self.create_index = create_index
+        self.page_pool = page_pool
 
     def startElement(self, name, attrs):
         self.tag = name
 
     def endElement(self, name):
         if name == 'page':
-            if num_pages % 100 == 0:
-                print(num_pages)
-            id_title_map[num_pages] = self.title.lower()
-            title, body, category, infobox, link, reference = self.page_processor.process_page(self.title, self.text)
-            self.create_index.index(title, body, category, infobox, link, reference)
+            if self.page_pool:
+                self.page_pool.add_page(self.title, self.text)
+            else:
+                id_title_map[num_pages] = self.title.lower()
+                title, body, category, infobox, link, reference = self.page_processor.process_page(self.title, self.text)
+                self.create_index.index(title, body, category, infobox, link, reference)
             self.tag = ""
             self.title = ""
             self.text = ""
@@ -373,129 +570,626 @@ class XMLParser(xml.sax.ContentHandler):
             self.text += content
 
 
+def decompress_streams(dump_path, start, end):
+    with open(dump_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # a range may span several bz2 streams, decompress handles concatenated streams
+    return bz2.decompress(data)
+
+
+class MultistreamReader():
+    def __init__(self, dump_path, index_path, num_workers, streams_per_task=10):
+        self.dump_path = dump_path
+        self.index_path = index_path
+        self.num_workers = num_workers
+        self.streams_per_task = streams_per_task
+
+    def read_stream_offsets(self):
+        # index lines are offset:page_id:title, with one offset per 100-page stream
+        offsets = {0, os.path.getsize(self.dump_path)}
+        if self.index_path.endswith('.bz2'):
+            f = bz2.open(self.index_path, 'rt', encoding="utf-8")
+        else:
+            f = open(self.index_path, 'r', encoding="utf-8")
+        with f:
+            for line in f:
+                if line.strip():
+                    offsets.add(int(line.split(':', 1)[0]))
+        return sorted(offsets)
+
+    def get_stream_ranges(self):
+        offsets = self.read_stream_offsets()
+        ranges = []
+        for i in range(0, len(offsets) - 1, self.streams_per_task):
+            ranges.append((offsets[i], offsets[min(i + self.streams_per_task, len(offsets) - 1)]))
+        return ranges
+
+    def parse(self, parser):
+        max_pending = 2 * self.num_workers
+        pending = deque()
+        with multiprocessing.Pool(self.num_workers) as pool:
+            for start, end in self.get_stream_ranges():
+                pending.append(pool.apply_async(decompress_streams, (self.dump_path, start, end)))
+                while len(pending) > max_pending:
+                    self.feed(parser, pending.popleft())
+            while pending:
+                self.feed(parser, pending.popleft())
+        parser.close()
+
+    def feed(self, parser, result):
+        with metrics.timer('index.decompress_wait'):
+            data = result.get()
+        with metrics.timer('index.sax_parse'):
+            parser.feed(data)
+
+
 class MergeFiles():
-    def __init__(self, num_itermed_files, write_data):
+    def __init__(self, num_itermed_files, write_data, fan_in=64, num_workers=1):
         self.num_itermed_files = num_itermed_files
         self.write_data = write_data
+        self.fan_in = fan_in
+        self.num_workers = num_workers
+        self.num_tokens = 0
+
+    def read_run(self, file_name):
+        with open(file_name, 'r', encoding="utf-8") as f:
+            for line in f:
+                line = line.strip('\n')
+                if len(line):
+                    token, postings = line.split('-', 1)
+                    yield token, postings
+        print(f'Removing file {file_name}')
+        os.remove(file_name)
+
+    def read_run_range(self, file_name, start, end):
+        # the lines between two byte offsets of a run, the run itself is removed once every range is merged
+        with open(file_name, 'rb') as f:
+            f.seek(start)
+            pos = start
+            while pos < end:
+                line = f.readline()
+                pos += len(line)
+                line = line.decode('utf-8').strip('\n')
+                if len(line):
+                    token, postings = line.split('-', 1)
+                    yield token, postings
+
+    def merge_runs(self, runs):
+        # runs are in page order and ties are popped by run number, so merged postings stay sorted by doc id
+        heap = []
+        for i, run in enumerate(runs):
+            entry = next(run, None)
+            if entry:
+                heap.append((entry[0], i, entry[1]))
+        heapq.heapify(heap)
+        while heap:
+            token = heap[0][0]
+            postings = []
+            while heap and heap[0][0] == token:
+                _, i, run_postings = heapq.heappop(heap)
+                postings.append(run_postings)
+                entry = next(runs[i], None)
+                if entry:
+                    heapq.heappush(heap, (entry[0], i, entry[1]))
+            yield token, ''.join(postings)
+
+    def reduce_runs(self, file_names):
+        merge_pass = 0
+        while len(file_names) > self.fan_in:
+            merged_names = []
+            for j in range(0, len(file_names), self.fan_in):
+                group = file_names[j:j + self.fan_in]
+                if len(group) == 1:
+                    merged_names.append(group[0])
+                    continue
+                merged_name = f'{index_dir}index_p{merge_pass}_{j // self.fan_in}.txt'
+                with metrics.timer('index.merge_pass'), open(merged_name, 'w', encoding="utf-8") as f:
+                    for token, postings in self.merge_runs([self.read_run(file_name) for file_name in group]):
+                        f.write(token + '-' + postings + '\n')
+                merged_names.append(merged_name)
+            file_names = merged_names
+            merge_pass += 1
+        return file_names
 
     def merge_files(self):
-        files_data = {}
-        line = {}
-        postings = {}
-        is_file_empty = {i: 1 for i in range(self.num_itermed_files)}
-        tokens = []
-        i = 0
-        while i < self.num_itermed_files:
-            files_data[i] = open(f'../wiki_index/index_{i}.txt', 'r', encoding="utf-8")
-            line[i] = files_data[i].readline().strip('\n')
-            postings[i] = line[i].split('-')
-            is_file_empty[i] = 0
-            new_token = postings[i][0]
-            if new_token not in tokens:
-                tokens.append(new_token)
-            i += 1
-        tokens.sort(reverse=True)
+        file_names = [f'{index_dir}index_{i}.txt' for i in range(self.num_itermed_files)]
+        file_names = self.reduce_runs(file_names)
+        if self.num_workers > 1:
+            return self.merge_ranges(file_names)
+        return self.write_merged(self.merge_runs([self.read_run(file_name) for file_name in file_names]))
+
+    def write_merged(self, merged):
         num_processed_postings = 0
         data_to_merge = defaultdict(str)
         num_files_final = 0
-        while sum(is_file_empty.values()) != self.num_itermed_files:
-            token = tokens.pop()
+        for token, postings in merged:
             num_processed_postings += 1
             if num_processed_postings % 30000 == 0:
-                num_files_final = self.write_data.write_final_files(data_to_merge, num_files_final)
+                num_files_final = self.write_final_files(data_to_merge, num_files_final)
                 data_to_merge = defaultdict(str)
-            i = 0
-            while i < self.num_itermed_files:
-                if is_file_empty[i] == 0:
-                    if token == postings[i][0]:
-                        line[i] = files_data[i].readline().strip('\n')
-                        data_to_merge[token] += postings[i][1]
-                        if len(line[i]):
-                            postings[i] = line[i].split('-')
-                            new_token = postings[i][0]
-                            if new_token not in tokens:
-                                tokens.append(new_token)
-                                tokens.sort(reverse=True)
-                        else:
-                            is_file_empty[i] = 1
-                            files_data[i].close()
-                            print(f'Removing file {str(i)}')
-                            os.remove(f'../wiki_index/index_{str(i)}.txt')
-                i += 1
-        num_files_final = self.write_data.write_final_files(data_to_merge, num_files_final)
+            data_to_merge[token] += postings
+        num_files_final = self.write_final_files(data_to_merge, num_files_final)
+        self.num_tokens = num_processed_postings
         return num_files_final
 
+    def write_final_files(self, data_to_merge, num_files_final):
+        with metrics.timer('index.write_final_files'):
+            num_files_final = self.write_data.write_final_files(data_to_merge, num_files_final)
+        metrics.count('index.final_tokens', len(data_to_merge))
+        return num_files_final
 
-if __name__ == '__main__':
-    start = time.time()
-    html_tags = re.compile('&amp;|&apos;|&gt;|&lt;|&nbsp;|&quot;')
-    stemmer = Stemmer('english')
-    stop_words = (set(stopwords.words("english")))
-    text_pre_processor = TextPreProcessor(html_tags, stemmer, stop_words)
-    page_processor = PageProcessor(text_pre_processor)
-    write_data = WriteData()
-    create_index = CreateIndex(write_data)
-    parser = xml.sax.make_parser()
-    parser.setFeature(xml.sax.handler.feature_namespaces, False)
-    xml_parser = XMLParser(page_processor, create_index)
-    parser.setContentHandler(xml_parser)
-    # modified to parse bz2 multistream filed
-    os.makedirs('../wiki_index/', exist_ok=True)
-    print('parsing')
-    parser.parse(BZ2File(sys.argv[1]))
-    print('done parsing?')
-    write_data.write_intermed_index()
-    write_data.write_id_title_map()
-    merge_files = MergeFiles(num_files, write_data)
-    num_files_final = merge_files.merge_files()
-    with open('../wiki_index/num_pages.txt', 'w', encoding="utf-8") as f:
-        f.write(str(num_pages))
+    def merge_ranges(self, file_names):
+        # the term space is cut at sampled tokens into one key range per worker. A worker seeks to its range in
+        # every run and writes the final files of that range into its own directory, which are renumbered after
+        # the ranges before it
+        splitters = get_splitters(file_names, self.num_workers)
+        run_offsets = []
+        for file_name in file_names:
+            with open(file_name, 'rb') as f:
+                size = os.path.getsize(file_name)
+                run_offsets.append([0] + [find_run_offset(f, size, splitter) for splitter in splitters] + [size])
+        pool = multiprocessing.Pool(self.num_workers, initializer=init_merge_worker, initargs=(metrics.enabled,))
+        pending = []
+        for r in range(len(splitters) + 1):
+            file_ranges = [(file_name, offsets[r], offsets[r + 1])
+                           for file_name, offsets in zip(file_names, run_offsets)]
+            range_dir = f'{index_dir}merge_{r}/'
+            merge_args = (file_ranges, range_dir, self.write_data.index_format, self.write_data.impact_pages)
+            pending.append((range_dir, pool.apply_async(merge_range, merge_args)))
+        num_files_final = 0
+        for range_dir, result in pending:
+            range_files, range_tokens, worker_metrics = result.get()
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+            if range_tokens:
+                self.write_data.add_range_files(range_dir, range_files, num_files_final)
+                num_files_final += range_files
+                self.num_tokens += range_tokens
+            shutil.rmtree(range_dir)
+        pool.close()
+        pool.join()
+        for file_name in file_names:
+            print(f'Removing file {file_name}')
+            os.remove(file_name)
+        return num_files_final
+
+
+def get_line_start(f, pos):
+    # offset of the first line that starts at or after pos
+    if pos == 0:
+        return 0
+    f.seek(pos - 1)
+    f.readline()
+    return f.tell()
+
+
+def find_run_offset(f, size, token):
+    # binary search for the first line of a sorted run whose token is not below token
+    token = token.encode('utf-8')
+    low, high = 0, size
+    while low < high:
+        mid = (low + high) // 2
+        f.seek(get_line_start(f, mid))
+        line = f.readline()
+        if not line or line.split(b'-', 1)[0] >= token:
+            high = mid
+        else:
+            low = mid + 1
+    return get_line_start(f, low)
+
+
+def get_splitters(file_names, num_ranges, samples_per_range=100):
+    # tokens at evenly spaced byte offsets of the runs, so ranges get about the same number of posting bytes
+    sizes = [os.path.getsize(file_name) for file_name in file_names]
+    step = max(1, sum(sizes) // (num_ranges * samples_per_range))
+    samples = []
+    for file_name, size in zip(file_names, sizes):
+        with open(file_name, 'rb') as f:
+            for pos in range(0, size, step):
+                f.seek(get_line_start(f, pos))
+                line = f.readline()
+                if line.strip():
+                    samples.append(line.split(b'-', 1)[0].decode('utf-8'))
+    samples.sort()
+    if not samples:
+        return []
+    return sorted({samples[len(samples) * r // num_ranges] for r in range(1, num_ranges)})
+
+
+def init_merge_worker(metrics_enabled=False):
+    metrics.reset()
+    metrics.enabled = metrics_enabled
+
+
+def merge_range(file_ranges, range_dir, index_format, impact_pages=None):
+    os.makedirs(range_dir, exist_ok=True)
+    write_data = WriteData(index_format, range_dir)
+    write_data.impact_pages = impact_pages
+    merge_files = MergeFiles(0, write_data)
+    runs = [merge_files.read_run_range(file_name, start, end) for file_name, start, end in file_ranges]
+    num_files_final = merge_files.write_merged(merge_files.merge_runs(runs))
+    write_data.close()
+    return num_files_final, merge_files.num_tokens, metrics.take() if metrics.enabled else None
+
+
+def split_tokens_info(index_dir):
     num_tokens_final = 0
-    with open('../wiki_index/tokens_info.txt', 'r', encoding="utf-8") as f:
+    with open(index_dir + 'tokens_info.txt', 'r', encoding="utf-8") as f:
         for line in f:
             num_tokens_final += 1
-    with open('../wiki_index/num_tokens.txt', 'w', encoding="utf-8") as f:
+    with open(index_dir + 'num_tokens.txt', 'w', encoding="utf-8") as f:
         f.write(str(num_tokens_final))
     char_list = [chr(i) for i in range(97, 123)]
     num_list = [str(i) for i in range(0, 10)]
-    with open(f'../wiki_index/tokens_info.txt', 'r', encoding="utf-8") as f:
+    with open(f'{index_dir}tokens_info.txt', 'r', encoding="utf-8") as f:
         for line in tqdm(f):
             if line[0] in char_list:
-                with open(f'../wiki_index/tokens_info_{line[0]}.txt', 'a', encoding="utf-8") as t:
+                with open(f'{index_dir}tokens_info_{line[0]}.txt', 'a', encoding="utf-8") as t:
                     t.write(line.strip())
                     t.write('\n')
             elif line[0] in num_list:
-                with open(f'../wiki_index/tokens_info_{line[0]}.txt', 'a', encoding="utf-8") as t:
+                with open(f'{index_dir}tokens_info_{line[0]}.txt', 'a', encoding="utf-8") as t:
                     t.write(line.strip())
                     t.write('\n')
             else:
-                with open(f'../wiki_index/tokens_info_others.txt', 'a', encoding="utf-8") as t:
+                with open(f'{index_dir}tokens_info_others.txt', 'a', encoding="utf-8") as t:
                     t.write(line.strip())
                     t.write('\n')
     for ch in tqdm(char_list):
         tok_count = 0
-        with open(f'../wiki_index/tokens_info_{ch}.txt', 'r', encoding="utf-8") as f:
-            for line in f:
-                tok_count += 1
-        with open(f'../wiki_index/tokens_info_{ch}_count.txt', 'w', encoding="utf-8") as f:
+        # small indexes, like a delta segment, need not have a token for every first character
+        if os.path.exists(f'{index_dir}tokens_info_{ch}.txt'):
+            with open(f'{index_dir}tokens_info_{ch}.txt', 'r', encoding="utf-8") as f:
+                for line in f:
+                    tok_count += 1
+        with open(f'{index_dir}tokens_info_{ch}_count.txt', 'w', encoding="utf-8") as f:
             f.write(str(tok_count))
     for num in tqdm(num_list):
         tok_count = 0
-        with open(f'../wiki_index/tokens_info_{num}.txt', 'r', encoding="utf-8") as f:
-            for line in f:
-                tok_count += 1
-        with open(f'../wiki_index/tokens_info_{num}_count.txt', 'w', encoding="utf-8") as f:
+        if os.path.exists(f'{index_dir}tokens_info_{num}.txt'):
+            with open(f'{index_dir}tokens_info_{num}.txt', 'r', encoding="utf-8") as f:
+                for line in f:
+                    tok_count += 1
+        with open(f'{index_dir}tokens_info_{num}_count.txt', 'w', encoding="utf-8") as f:
             f.write(str(tok_count))
-    try:
+    if os.path.exists(index_dir + 'tokens_info_others.txt'):
         tok_count = 0
-        with open('../wiki_index/tokens_info_others.txt', 'r', encoding="utf-8") as f:
-            tok_count += 1
-        with open(f'../wiki_index/tokens_info_others_count.txt', 'w', encoding="utf-8") as f:
+        with open(index_dir + 'tokens_info_others.txt', 'r', encoding="utf-8") as f:
+            for line in f:
+                tok_count += 1
+        with open(f'{index_dir}tokens_info_others_count.txt', 'w', encoding="utf-8") as f:
             f.write(str(tok_count))
-    except:
-        pass
-    os.remove('../wiki_index/tokens_info.txt')
-    print('Total tokens', num_tokens_final)
-    print('Final files', num_files_final)
+    os.remove(index_dir + 'tokens_info.txt')
+    return num_tokens_final
+
+
+def get_segment_dir(index_root, name):
+    return index_root if name == '.' else f'{index_root}{name}/'
+
+
+def lock_segments(index_root):
+    # segment builds, deletions and compactions rewrite segments.txt and tombstones, they run one at a time
+    lock_file = open(index_root + 'segments.lock', 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def get_live_segments(index_root):
+    segments = read_segments(index_root)
+    if segments is None:
+        # an index built from a full dump is the first segment
+        segments = []
+        if os.path.exists(index_root + 'num_pages.txt'):
+            with open(index_root + 'num_pages.txt', 'r', encoding="utf-8") as f:
+                segments.append(('.', 0, int(f.readline().strip())))
+    return segments
+
+
+def get_next_segment_name(segments):
+    segment_nums = [int(name.split('_')[-1]) for name, _, _ in segments if name != '.']
+    return f'segments/seg_{max(segment_nums, default=0) + 1}'
+
+
+def read_segment_titles(segment_dir):
+    if os.path.exists(segment_dir + 'id_title_offsets.bin'):
+        title_store = TitleStore(segment_dir + 'id_title_offsets.bin', segment_dir + 'id_title_blob.bin')
+        return [title_store.get(i) for i in range(title_store.num_titles)]
+    with open(segment_dir + 'id_title_map.txt', 'r', encoding="utf-8") as f:
+        return [line.rstrip('\n').split('-', 1)[1] for line in f if line.strip()]
+
+
+def read_tokens_info_counts(index_dir):
+    counts = {}
+    for name in [chr(i) for i in range(97, 123)] + [str(i) for i in range(0, 10)] + ['others']:
+        if os.path.exists(f'{index_dir}tokens_info_{name}_count.txt'):
+            with open(f'{index_dir}tokens_info_{name}_count.txt', 'r', encoding="utf-8") as f:
+                counts[name] = int(f.readline().strip())
+    return counts
+
+
+def get_manifest(index_dir, index_format, num_pages, num_tokens, stop_words):
+    return {'index_format': index_format, 'postings_version': POSTINGS_VERSION, 'num_pages': num_pages,
+            'num_tokens': num_tokens, 'tokens_info_counts': read_tokens_info_counts(index_dir),
+            'field_weights': FIELD_WEIGHTS, 'stemmer_language': stemmer_language, 'stop_words': sorted(stop_words)}
+
+
+def write_segment_title_prefixes(segment_dir):
+    with metrics.timer('index.title_prefixes'):
+        write_title_prefixes(segment_dir + 'title_prefixes.bin', read_segment_titles(segment_dir))
+
+
+def add_tombstones(index_root, segments, titles):
+    for name, base, segment_pages in segments:
+        segment_dir = get_segment_dir(index_root, name)
+        tombstones = read_tombstones(segment_dir) or bytearray((segment_pages + 7) // 8)
+        num_deleted = 0
+        for i, title in enumerate(read_segment_titles(segment_dir)):
+            if title in titles and not is_deleted(tombstones, i):
+                tombstones[i >> 3] |= 1 << (i & 7)
+                num_deleted += 1
+        if num_deleted:
+            write_tombstones(segment_dir, tombstones)
+            print(f'Deleted {num_deleted} pages from segment {name}')
+
+
+def read_segment_run(segment_dir, base):
+    # rebuilds the intermediate run format (token-id:t1b2...;) from a segment's final files, without deleted pages
+    with open(segment_dir + 'index_format.txt', 'r', encoding="utf-8") as f:
+        segment_format = f.readline().strip()
+    term_dictionary = TermDictionary(segment_dir + 'tokens_dict.bin')
+    tombstones = read_tombstones(segment_dir)
+    postings_files = {}
+    for token, (file_num, _, pointers, counts) in term_dictionary.items():
+        docs = defaultdict(str)
+        for field, field_char, pointer, count in zip(FIELDS, 'tbcilr', pointers, counts):
+            if not count:
+                continue
+            if segment_format == 'binary':
+                if (field, file_num) not in postings_files:
+                    postings_files[(field, file_num)] = open_postings_file(f'{segment_dir}{field}_data_{file_num}.bin')
+                postings = decode_postings(postings_files[(field, file_num)], pointer)
+                field_postings = zip(postings.ids, postings.freqs)
+            else:
+                line = linecache.getline(f'{segment_dir}{field}_data_{file_num}.txt', pointer).strip()
+                field_postings = (map(int, post.split(':')) for post in line.split('-', 1)[1].split(';'))
+            for id, freq in field_postings:
+                if not is_deleted(tombstones, id - base):
+                    docs[id] += field_char + str(freq)
+        if docs:
+            yield token, ''.join(f'{id}:{fields};' for id, fields in sorted(docs.items()))
+    linecache.clearcache()
+
+
+def compact_segments(index_root, max_pages, fan_in, index_format, merge_workers=1):
+    global index_dir
+    lock_file = lock_segments(index_root)
+    segments = get_live_segments(index_root)
+    # runs of adjacent small segments are merged, so each merged segment still covers one range of doc ids
+    groups, group = [], []
+    for segment in segments + [None]:
+        if segment is not None and segment[0] != '.' and segment[2] <= max_pages:
+            group.append(segment)
+            continue
+        if len(group) > 1:
+            groups.append(group)
+        group = []
+    for group in groups:
+        name = get_next_segment_name(segments)
+        index_dir = get_segment_dir(index_root, name)
+        os.makedirs(index_dir, exist_ok=True)
+        print(f'Compacting {", ".join(segment[0] for segment in group)} into {name}')
+        write_data = WriteData(index_format)
+        for i, (segment_name, base, _) in enumerate(group):
+            segment_dir = get_segment_dir(index_root, segment_name)
+            with open(f'{index_dir}index_{i}.txt', 'w', encoding="utf-8") as f:
+                for token, postings in read_segment_run(segment_dir, base):
+                    f.write(token + '-' + postings + '\n')
+            write_data.write_id_title_map({base + j: title for j, title in enumerate(read_segment_titles(segment_dir))})
+        MergeFiles(len(group), write_data, fan_in, merge_workers).merge_files()
+        write_data.close()
+        write_segment_title_prefixes(index_dir)
+        group_pages = sum(segment[2] for segment in group)
+        with open(index_dir + 'num_pages.txt', 'w', encoding="utf-8") as f:
+            f.write(str(group_pages))
+        with open(index_dir + 'index_format.txt', 'w', encoding="utf-8") as f:
+            f.write(index_format)
+        num_tokens = split_tokens_info(index_dir)
+        manifest = read_manifest(get_segment_dir(index_root, group[0][0]))
+        if manifest is not None:
+            # a compacted segment keeps the stop words of the segments it replaces
+            write_manifest(index_dir, get_manifest(index_dir, index_format, group_pages, num_tokens,
+                                                   manifest['stop_words']))
+        i = segments.index(group[0])
+        segments[i:i + len(group)] = [(name, group[0][1], group_pages)]
+        write_segments(index_root, segments)
+        write_segments(index_root, (read_segments(index_root, RETIRED_SEGMENTS_FILE) or []) + group,
+                       RETIRED_SEGMENTS_FILE)
+    remove_retired_segments(index_root)
+    lock_file.close()
+    return len(groups)
+
+
+def remove_retired_segments(index_root):
+    # running searchers open segment files lazily, so a replaced segment is only deleted once no searcher holds
+    # its lock. The others are retried by the next compaction
+    retired = []
+    for segment in read_segments(index_root, RETIRED_SEGMENTS_FILE) or []:
+        segment_dir = get_segment_dir(index_root, segment[0])
+        if not os.path.isdir(segment_dir):
+            continue
+        with open(segment_dir + SEGMENT_LOCK_FILE, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                retired.append(segment)
+                continue
+            shutil.rmtree(segment_dir)
+    if retired:
+        print('Kept', len(retired), 'replaced segments that searchers still read')
+    write_segments(index_root, retired, RETIRED_SEGMENTS_FILE)
+
+
+def get_shards(num_pages, num_shards):
+    shard_pages = max(1, -(-num_pages // num_shards))
+    return [(f'shard_{k}', k * shard_pages, max(0, min(shard_pages, num_pages - k * shard_pages)))
+            for k in range(num_shards)]
+
+
+def write_shard_titles(index_root, shards):
+    title_store = TitleStore(index_root + 'id_title_offsets.bin', index_root + 'id_title_blob.bin')
+    for name, base, shard_pages in shards:
+        title_store_writer = TitleStoreWriter(f'{index_root}{name}/id_title_offsets.bin',
+                                              f'{index_root}{name}/id_title_blob.bin')
+        title_store_writer.add(title_store.get(id) for id in range(base, base + shard_pages))
+        title_store_writer.close()
+
+
+if __name__ == '__main__':
+    start = time.time()
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('dump', action='store', type=str, nargs='?')
+    arg_parser.add_argument('--workers', action='store', default=0, type=int)
+    arg_parser.add_argument('--multistream-index', action='store', type=str)
+    arg_parser.add_argument('--decompress-workers', action='store', default=2, type=int)
+    arg_parser.add_argument('--merge-fan-in', action='store', default=64, type=int)
+    arg_parser.add_argument('--merge-workers', action='store', default=1, type=int)
+    arg_parser.add_argument('--index-format', action='store', default='text', choices=['text', 'binary'])
+    arg_parser.add_argument('--shards', action='store', default=1, type=int)
+    arg_parser.add_argument('--segment', action='store_true')
+    arg_parser.add_argument('--delete-titles', action='store', type=str)
+    arg_parser.add_argument('--compact', action='store_true')
+    arg_parser.add_argument('--compact-max-pages', action='store', default=100000, type=int)
+    arg_parser.add_argument('--metrics-file', action='store', type=str)
+    arg_parser.add_argument('--metrics-format', action='store', default='json', choices=['json', 'prometheus'])
+    arg_parser.add_argument('--metrics-interval', action='store', default=10.0, type=float)
+    arg_parser.add_argument('--mem-budget', action='store', default='1G', type=parse_size)
+    arg_parser.add_argument('--max-pending-flushes', action='store', default=2, type=int)
+    arg_parser.add_argument('--impacts', action='store_true')
+    args = arg_parser.parse_args()
+    if args.dump is None and not args.compact and not args.delete_titles:
+        arg_parser.error('a dump is needed unless only compacting or deleting')
+    if args.dump is not None and args.delete_titles and not args.segment:
+        arg_parser.error('--delete-titles with a dump needs --segment')
+    if args.shards > 1 and (args.segment or args.compact or args.delete_titles):
+        arg_parser.error('--shards only works for full builds')
+    if args.merge_fan_in < 2:
+        # a pass over fewer than two runs at a time never reduces their number
+        arg_parser.error('--merge-fan-in must be at least 2')
+    if args.shards > 1 and args.merge_workers > 1:
+        arg_parser.error('--merge-workers does not work with --shards')
+    if args.impacts and (args.index_format != 'binary' or args.shards > 1 or args.segment or args.dump is None):
+        # impacts fold in idfs, which are only final for a full, unsharded build
+        arg_parser.error('--impacts needs a full binary build without --shards or --segment')
+    if args.metrics_file is not None:
+        metrics.start_exporter(args.metrics_file, args.metrics_format, args.metrics_interval)
+    index_root = index_dir
+    os.makedirs(index_root, exist_ok=True)
+    deleted_titles = set()
+    if args.delete_titles:
+        with open(args.delete_titles, 'r', encoding="utf-8") as f:
+            deleted_titles = {line.strip().lower() for line in f if line.strip()}
+    if args.segment or args.dump is None:
+        lock_file = lock_segments(index_root)
+        segments = get_live_segments(index_root)
+    if args.segment:
+        # a delta dump becomes a new segment whose doc ids continue after the last segment
+        segment_name = get_next_segment_name(segments)
+        index_dir = get_segment_dir(index_root, segment_name)
+        num_pages = segments[-1][1] + segments[-1][2] if segments else 0
+    first_page_id = num_pages
+    if args.dump is not None:
+        stemmer = Stemmer(stemmer_language)
+        stop_words = (set(stopwords.words(stemmer_language)))
+        text_pre_processor = TextPreProcessor(html_tags, stemmer, stop_words)
+        page_processor = PageProcessor(text_pre_processor)
+        write_data = WriteData(args.index_format)
+        create_index = CreateIndex(write_data, args.mem_budget, args.max_pending_flushes)
+        parser = xml.sax.make_parser()
+        parser.setFeature(xml.sax.handler.feature_namespaces, False)
+        page_pool = None
+        if args.workers > 0:
+            page_pool = PagePool(args.workers, create_index, html_tags, stop_words)
+        xml_parser = XMLParser(page_processor, create_index, page_pool)
+        parser.setContentHandler(xml_parser)
+        # modified to parse bz2 multistream filed
+        os.makedirs(index_dir, exist_ok=True)
+        print('parsing')
+        with metrics.timer('index.parse'):
+            if args.multistream_index:
+                MultistreamReader(args.dump, args.multistream_index, args.decompress_workers).parse(parser)
+            elif metrics.enabled:
+                parser.parse(TimedReader(BZ2File(args.dump), 'index.bz2_decode', metrics))
+            else:
+                parser.parse(BZ2File(args.dump))
+            if page_pool:
+                page_pool.finish()
+        print('done parsing?')
+        create_index.finish()
+        parse_end = time.time()
+        print('Parsed in -', parse_end - start)
+        if args.shards > 1:
+            # doc id ranges are only known once every page is parsed, shards are split off while merging
+            shards = get_shards(num_pages, args.shards)
+            for name, _, _ in shards:
+                os.makedirs(f'{index_dir}{name}/', exist_ok=True)
+            merge_files = MergeFiles(num_files, ShardedWriteData(args.index_format, index_dir, shards),
+                                     args.merge_fan_in)
+        else:
+            if args.impacts:
+                write_data.impact_pages = num_pages - first_page_id
+            merge_files = MergeFiles(num_files, write_data, args.merge_fan_in, args.merge_workers)
+        with metrics.timer('index.merge'):
+            num_files_final = merge_files.merge_files()
+        if args.shards > 1:
+            merge_files.write_data.close()
+        write_data.close()
+        write_segment_title_prefixes(index_dir)
+        print('Merged in -', time.time() - parse_end)
+        with open(index_dir + 'num_pages.txt', 'w', encoding="utf-8") as f:
+            f.write(str(num_pages - first_page_id))
+        with open(index_dir + 'index_format.txt', 'w', encoding="utf-8") as f:
+            f.write(args.index_format)
+        if args.shards > 1:
+            write_shard_titles(index_dir, shards)
+            shard_manifests = []
+            for name, base, shard_pages in shards:
+                shard_dir = f'{index_dir}{name}/'
+                with open(shard_dir + 'num_pages.txt', 'w', encoding="utf-8") as f:
+                    f.write(str(shard_pages))
+                with open(shard_dir + 'index_format.txt', 'w', encoding="utf-8") as f:
+                    f.write(args.index_format)
+                shard_tokens = split_tokens_info(shard_dir)
+                write_manifest(shard_dir, get_manifest(shard_dir, args.index_format, shard_pages, shard_tokens,
+                                                       stop_words))
+                shard_manifests.append({'name': name, 'base': base, 'num_pages': shard_pages,
+                                        'num_tokens': shard_tokens})
+            write_segments(index_dir, shards, SHARDS_FILE)
+            num_tokens_final = TermDictionary(index_dir + 'tokens_dict.bin').num_terms
+            manifest = get_manifest(index_dir, args.index_format, num_pages - first_page_id, num_tokens_final,
+                                    stop_words)
+            write_manifest(index_dir, dict(manifest, shards=shard_manifests))
+        else:
+            num_tokens_final = split_tokens_info(index_dir)
+            write_manifest(index_dir, get_manifest(index_dir, args.index_format, num_pages - first_page_id,
+                                                   num_tokens_final, stop_words))
+        print('Total tokens', num_tokens_final)
+        print('Final files', num_files_final)
+    if args.segment:
+        # pages of the new segment replace the pages with the same title in older segments
+        add_tombstones(index_root, segments, set(read_segment_titles(index_dir)) | deleted_titles)
+        segments.append((segment_name, first_page_id, num_pages - first_page_id))
+        write_segments(index_root, segments)
+        print('Added segment', segment_name)
+    elif args.dump is None and deleted_titles:
+        add_tombstones(index_root, segments, deleted_titles)
+        write_segments(index_root, segments)
+    if args.segment or args.dump is None:
+        lock_file.close()
+    if args.compact:
+        print('Compacted', compact_segments(index_root, args.compact_max_pages, args.merge_fan_in, args.index_format,
+                                          args.merge_workers),
+              'segment groups')
+    metrics.stop_exporter()
     end = time.time()
     print('Finished in -', end - start)
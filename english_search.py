@@ -1,15 +1,107 @@
 import argparse
+import fcntl
+import heapq
+import json
 import linecache
 import math
-from collections import Counter
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from itertools import accumulate
 
-from english_indexer import *
+from Stemmer import Stemmer
+
+from index_format import (BLOCK_SIZE, FIELD_WEIGHTS, FIELDS, SEGMENT_LOCK_FILE, SHARDS_FILE, BlockPostings, Postings,
+                          PostingsCursor, TermDictionary, TitlePrefixes, TitleStore, decode_impacts, decode_postings,
+                          decode_postings_numpy, get_title_rank_key, is_deleted, open_postings_file,
+                          parse_size, read_impact_offsets, read_manifest, read_segments, read_tombstones)
+from lazy_imports import lazy_import
+from metrics import metrics
+from text_processing import TextPreProcessor, html_tags, stemmer_language
+
+np = lazy_import('numpy')
+
+
+class LRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if size > self.max_bytes:
+                return
+            if key in self.entries:
+                self.num_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_size
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return f'{self.hits} hits, {self.misses} misses ({hit_rate:.1%}), {len(self.entries)} entries, ' \
+               f'{self.num_bytes} bytes'
+
+
+def get_postings_size(postings):
+    # block tables are built lazily for text indexes, one pair of entries per block is counted up front
+    itemsize = postings.ids.itemsize
+    return 2 * itemsize * (len(postings) + (len(postings) + BLOCK_SIZE - 1) // BLOCK_SIZE) + 100
+
+
+def get_results_size(key, results):
+    return sys.getsizeof(repr(key)) + sys.getsizeof(results) + 100 * len(results)
 
 
 # https://medium.com/analytics-vidhya/search-engine-in-python-from-scratch-c3f7cc453250
 class FileTraverser():
-    def __init__(self):
-        pass
+    def __init__(self, index_dir='../wiki_index/', use_numpy=False, use_impacts=True):
+        self.index_dir = index_dir
+        self.use_numpy = use_numpy
+        self.manifest = read_manifest(self.index_dir)
+        self.index_format = 'text'
+        if self.manifest is not None:
+            self.index_format = self.manifest['index_format']
+        elif os.path.exists(self.index_dir + 'index_format.txt'):
+            with open(self.index_dir + 'index_format.txt', 'r') as f:
+                self.index_format = f.readline().strip()
+        # token counts of the tokens_info files, indexes without a manifest read each count file once
+        self.tokens_info_counts = dict(self.manifest['tokens_info_counts']) if self.manifest is not None else {}
+        self.postings_files = {}
+        self.term_dictionary = None
+        if os.path.exists(self.index_dir + 'tokens_dict.bin'):
+            self.term_dictionary = TermDictionary(self.index_dir + 'tokens_dict.bin')
+        self.title_store = None
+        if os.path.exists(self.index_dir + 'id_title_offsets.bin'):
+            self.title_store = TitleStore(self.index_dir + 'id_title_offsets.bin',
+                                          self.index_dir + 'id_title_blob.bin')
+        self.impact_offsets = None
+        if use_impacts and os.path.exists(self.index_dir + 'impact_offsets.bin'):
+            self.impact_offsets = read_impact_offsets(self.index_dir + 'impact_offsets.bin')
+        self.title_prefixes = None
+        if os.path.exists(self.index_dir + 'title_prefixes.bin'):
+            self.title_prefixes = TitlePrefixes(self.index_dir + 'title_prefixes.bin')
 
     def search_token(self, high, filename, inp_token):
         low = 0
@@ -27,65 +119,385 @@ class FileTraverser():
         return None
 
     def search_title(self, page_id):
-        title = linecache.getline('../wiki_index/id_title_map.txt', int(page_id) + 1).strip()
+        if self.title_store is not None:
+            return self.title_store.get(int(page_id))
+        title = linecache.getline(self.index_dir + 'id_title_map.txt', int(page_id) + 1).strip()
         title = title.split('-', 1)[1]
         return title
 
-    def search_field_file(self, field, file_num, line_num):
+    def complete_title(self, prefix, num_results, tombstones=None):
+        if self.title_prefixes is None:
+            raise ValueError(f'{self.index_dir} has no title_prefixes.bin, rebuild the index to complete titles')
+        return self.title_prefixes.complete(prefix, num_results, tombstones)
+
+    def search_field_file(self, field, file_num, line_num, lazy=False):
         if line_num != '':
-            line = linecache.getline(f'../wiki_index/{field}_data_{str(file_num)}.txt',
+            if self.index_format == 'binary':
+                return self.search_binary_field_file(field, file_num, int(line_num), lazy)
+            line = linecache.getline(f'{self.index_dir}{field}_data_{str(file_num)}.txt',
                                      int(line_num)).strip()
             postings = line.split('-')[1]
-            return postings
-        return ''
+            if self.use_numpy:
+                values = np.array(postings.replace(':', ';').split(';'), dtype=np.int64)
+                return Postings(values[0::2], values[1::2])
+            ids, freqs = array('i'), array('i')
+            for post in postings.split(';'):
+                id, freq = post.split(':')
+                ids.append(int(id))
+                freqs.append(int(freq))
+            return Postings(ids, freqs)
+        if self.use_numpy:
+            return Postings(np.empty(0, np.int64), np.empty(0, np.int64))
+        return Postings(array('i'), array('i'))
+
+    def search_binary_field_file(self, field, file_num, offset, lazy=False):
+        key = (field, file_num)
+        if key not in self.postings_files:
+            self.postings_files[key] = open_postings_file(f'{self.index_dir}{field}_data_{str(file_num)}.bin')
+        if field == 'impact':
+            return decode_impacts(self.postings_files[key], offset, self.use_numpy)
+        # a lazy posting list only decodes its skip entries, its blocks are decoded as a cursor reaches them
+        if lazy and not self.use_numpy:
+            return BlockPostings(self.postings_files[key], offset)
+        if self.use_numpy:
+            return decode_postings_numpy(self.postings_files[key], offset)
+        return decode_postings(self.postings_files[key], offset)
+
+    def get_impact_pointer(self, token):
+        # the file number and offset of the token's impact list, the offset is 0 for a token without one
+        i = self.term_dictionary.find(token)
+        if i is None:
+            return None
+        return self.term_dictionary.get_record(i)[0], self.impact_offsets[i]
+
+    def get_tokens_info_count(self, name):
+        if name not in self.tokens_info_counts:
+            with open(f'{self.index_dir}tokens_info_{name}_count.txt', 'r') as f:
+                self.tokens_info_counts[name] = int(f.readline().strip())
+        return self.tokens_info_counts[name]
 
     def get_token_info(self, token):
+        if self.term_dictionary is not None:
+            term = self.term_dictionary.lookup(token)
+            if term is None:
+                return None
+            file_num, freq, pointers, _ = term
+            return [file_num, freq] + [pointer if pointer else '' for pointer in pointers]
         char_list = [chr(i) for i in range(97, 123)]
         num_list = [str(i) for i in range(0, 10)]
         if token[0] in char_list:
-            with open(f'../wiki_index/tokens_info_{token[0]}_count.txt', 'r') as f:
-                num_tokens = int(f.readline().strip())
-            tokens_info_pointer = f'../wiki_index/tokens_info_{token[0]}.txt'
+            num_tokens = self.get_tokens_info_count(token[0])
+            tokens_info_pointer = f'{self.index_dir}tokens_info_{token[0]}.txt'
             token_info = self.search_token(num_tokens, tokens_info_pointer, token)
         elif token[0] in num_list:
-            with open(f'../wiki_index/tokens_info_{token[0]}_count.txt', 'r') as f:
-                num_tokens = int(f.readline().strip())
-            tokens_info_pointer = f'../wiki_index/tokens_info_{token[0]}.txt'
+            num_tokens = self.get_tokens_info_count(token[0])
+            tokens_info_pointer = f'{self.index_dir}tokens_info_{token[0]}.txt'
             token_info = self.search_token(num_tokens, tokens_info_pointer, token)
         else:
-            with open(f'../wiki_index/tokens_info_others_count.txt', 'r') as f:
-                num_tokens = int(f.readline().strip())
-            tokens_info_pointer = f'../wiki_index/tokens_info_others.txt'
+            num_tokens = self.get_tokens_info_count('others')
+            tokens_info_pointer = f'{self.index_dir}tokens_info_others.txt'
             token_info = self.search_token(num_tokens, tokens_info_pointer, token)
         return token_info
 
 
+class ScoringTerm:
+    def __init__(self, weightage, idf, postings):
+        self.weightage = weightage
+        self.idf = idf
+        self.postings = postings
+
+    def score(self, freq):
+        return self.weightage * (1 + math.log(freq)) * self.idf
+
+    def max_score(self, max_freq):
+        # 1 + log(freq) is at least 1, so with a negative idf a frequency of 1 scores highest
+        if self.idf < 0:
+            return self.score(1)
+        return self.score(max_freq)
+
+
+class ImpactTerm(ScoringTerm):
+    # the freqs of an impact list are quantized scores with the field weights and the idf folded in, the scale
+    # turns them back into score units
+    def __init__(self, postings):
+        super().__init__(1.0, postings.scale, postings)
+
+    def score(self, impact):
+        return self.idf * impact
+
+    def max_score(self, max_impact):
+        if self.idf < 0:
+            return 0.0
+        return self.score(max_impact)
+
+
 class Ranker:
-    def __init__(self, num_pages):
+    def __init__(self, num_pages, ranking='exhaustive', field_weights=None):
         self.num_pages = num_pages
+        self.ranking = ranking
+        self.weightage_dict = dict(field_weights or FIELD_WEIGHTS)
 
-    def do_ranking(self, page_freq, page_postings):
-        result = defaultdict(float)
-        weightage_dict = {'title': 1.0, 'body': 0.6, 'category': 0.4, 'infobox': 0.75, 'link': 0.20, 'reference': 0.25}
+    def get_scoring_terms(self, page_freq, page_postings):
+        terms = []
         for token, field_post_dict in page_postings.items():
             for field, postings in field_post_dict.items():
-                weightage = weightage_dict[field]
-                if len(postings) > 0:
-                    for post in postings.split(';'):
-                        id, post = post.split(':')
-                        result[id] += weightage * (1 + math.log(int(post))) * math.log(
-                            (self.num_pages - int(page_freq[token])) / int(page_freq[token]))
+                if field == 'impact':
+                    terms.append(ImpactTerm(postings))
+                # a token in every page has no idf, log(0) used to raise
+                elif len(postings) > 0 and page_freq[token] < self.num_pages:
+                    idf = math.log((self.num_pages - page_freq[token]) / page_freq[token])
+                    terms.append(ScoringTerm(self.weightage_dict[field], idf, postings))
+        return terms
+
+    def score_all(self, terms):
+        result = defaultdict(float)
+        for term in terms:
+            # few distinct frequencies repeat across a list, each is scored once
+            score_cache = {}
+            for id, freq in zip(term.postings.ids, term.postings.freqs):
+                contribution = score_cache.get(freq)
+                if contribution is None:
+                    contribution = score_cache[freq] = term.score(freq)
+                result[id] += contribution
         return result
 
+    def top_k(self, terms, num_results, positive_only=False):
+        # results are ordered by score and then by doc id, whichever ranking is used
+        if self.ranking == 'maxscore':
+            return self.max_score_top_k(terms, num_results, positive_only)
+        return self.exhaustive_top_k(terms, num_results, positive_only)
+
+    def exhaustive_top_k(self, terms, num_results, positive_only=False):
+        result = self.score_all(terms)
+        results = [(id, score) for id, score in result.items() if score > 0 or not positive_only]
+        return heapq.nsmallest(num_results, results, key=lambda item: (-item[1], item[0]))
+
+    def get_prune_limit(self, threshold):
+        # bounds below the limit cannot reach the threshold, the slack covers rounding differences between
+        # partial sums taken in bound order and exact scores summed in term order
+        return threshold - 1e-9 * max(1.0, abs(threshold))
+
+    def score_documents(self, terms, doc_ids):
+        # doc_ids are sorted, every list is walked once with a cursor
+        scores = [0.0] * len(doc_ids)
+        for term in terms:
+            cursor = PostingsCursor(term.postings)
+            for i, doc_id in enumerate(doc_ids):
+                next_id = cursor.advance(doc_id)
+                if next_id is None:
+                    break
+                if next_id == doc_id:
+                    scores[i] += term.score(cursor.freq())
+        return scores
+
+    def get_kth_score(self, scores, num_results):
+        return heapq.nlargest(num_results, scores)[-1]
+
+    def conjunctive_top_k(self, terms, required, num_results, positive_only=False):
+        # only documents in a posting list of every required token are scored. required holds the posting lists
+        # of each required token, a token's cursors are advanced together and its next doc id is their smallest
+        if num_results <= 0 or not required or not all(required):
+            return []
+        cursors = {}
+        required_postings = [postings for postings_list in required for postings in postings_list]
+        for postings in required_postings + [term.postings for term in terms]:
+            if id(postings) not in cursors:
+                cursors[id(postings)] = PostingsCursor(postings)
+        # the token with the fewest postings proposes candidates, the others skip ahead to them
+        required_cursors = sorted(([cursors[id(postings)] for postings in postings_list] for postings_list in required),
+                                  key=lambda token_cursors: sum(len(cursor.postings) for cursor in token_cursors))
+        term_cursors = [cursors[id(term.postings)] for term in terms]
+        results = []
+        doc_id = self.next_match(required_cursors, 0)
+        while doc_id is not None:
+            # scores are summed in term order, the same as score_all
+            score = 0.0
+            for term, cursor in zip(terms, term_cursors):
+                if cursor.advance(doc_id) == doc_id:
+                    score += term.score(cursor.freq())
+            if score > 0 or not positive_only:
+                results.append((int(doc_id), score))
+            doc_id = self.next_match(required_cursors, doc_id + 1)
+        metrics.count('query.blocks_decoded', sum(cursor.blocks_decoded for cursor in cursors.values()))
+        return heapq.nsmallest(num_results, results, key=lambda item: (-item[1], item[0]))
+
+    def next_match(self, required_cursors, doc_id):
+        # the first doc id from doc_id on that every required token has, None when one of them runs out
+        while True:
+            for token_cursors in required_cursors:
+                next_ids = [next_id for next_id in (cursor.advance(doc_id) for cursor in token_cursors)
+                            if next_id is not None]
+                if not next_ids:
+                    return None
+                if min(next_ids) != doc_id:
+                    doc_id = min(next_ids)
+                    break
+            else:
+                return doc_id
+
+    def max_score_top_k(self, terms, num_results, positive_only=False):
+        if num_results <= 0:
+            return []
+        if any(term.idf < 0 for term in terms):
+            # partial scores are only lower bounds on the final score when every contribution is positive
+            for term in terms:
+                if isinstance(term.postings, BlockPostings):
+                    term.postings = term.postings.decode()
+            return self.exhaustive_top_k(terms, num_results, positive_only)
+        block_last_ids, block_bounds = [], []
+        for term in terms:
+            last_ids, max_freqs = term.postings.get_block_maxes()
+            block_last_ids.append(last_ids)
+            block_bounds.append([term.max_score(max_freq) for max_freq in max_freqs])
+        upper_bounds = [max(bounds) for bounds in block_bounds]
+        # lists are visited from the highest upper bound down, remaining_bounds[j] bounds what the lists
+        # after the j-th one can still add to any document
+        order = sorted(range(len(terms)), key=lambda t: upper_bounds[t], reverse=True)
+        remaining_bounds = list(accumulate([upper_bounds[t] for t in reversed(order)][:-1], initial=0.0))[::-1]
+        threshold = 0.0 if positive_only else -math.inf
+        accumulators = {}
+        blocks_decoded = 0
+        j = 0
+        # while a document missing from the accumulators could still reach the top k every posting is added
+        while j < len(order) and upper_bounds[order[j]] + remaining_bounds[j] >= self.get_prune_limit(threshold):
+            term = terms[order[j]]
+            postings = term.postings.decode() if isinstance(term.postings, BlockPostings) else term.postings
+            blocks_decoded += len(block_last_ids[order[j]])
+            score_cache = {}
+            for id, freq in zip(postings.ids, postings.freqs):
+                contribution = score_cache.get(freq)
+                if contribution is None:
+                    contribution = score_cache[freq] = term.score(freq)
+                accumulators[id] = accumulators.get(id, 0.0) + contribution
+            j += 1
+            if len(accumulators) >= num_results:
+                threshold = max(threshold, self.get_kth_score(accumulators.values(), num_results))
+        # afterwards only documents already seen are scored, and documents whose bound cannot reach the
+        # k-th best partial score are dropped
+        candidates = sorted(accumulators)
+        for j in range(j, len(order)):
+            term = terms[order[j]]
+            prune_limit = self.get_prune_limit(threshold)
+            if len(candidates) * 8 > len(term.postings):
+                # with many candidates left one pass over the list is cheaper than a lookup per candidate
+                postings = term.postings.decode() if isinstance(term.postings, BlockPostings) else term.postings
+                blocks_decoded += len(block_last_ids[order[j]])
+                candidate_set = set(candidates)
+                for id, freq in zip(postings.ids, postings.freqs):
+                    if id in candidate_set:
+                        accumulators[id] += term.score(freq)
+            else:
+                # a lazy list only decodes the blocks a candidate is looked up in
+                cursor = PostingsCursor(term.postings)
+                last_ids, bounds = block_last_ids[order[j]], block_bounds[order[j]]
+                next_candidates = []
+                b = 0
+                for doc_id in candidates:
+                    while b < len(last_ids) and last_ids[b] < doc_id:
+                        b += 1
+                    if b < len(last_ids):
+                        # the block max bounds this list for the candidate, a block that cannot lift it to the
+                        # threshold is not searched
+                        if accumulators[doc_id] + bounds[b] + remaining_bounds[j] < prune_limit:
+                            continue
+                        if cursor.advance(doc_id) == doc_id:
+                            accumulators[doc_id] += term.score(cursor.freq())
+                    next_candidates.append(doc_id)
+                candidates = next_candidates
+                blocks_decoded += cursor.blocks_decoded
+            candidates = [d for d in candidates if accumulators[d] + remaining_bounds[j] >= prune_limit]
+            if len(candidates) >= num_results:
+                threshold = max(threshold, self.get_kth_score((accumulators[d] for d in candidates), num_results))
+        metrics.count('query.blocks_decoded', blocks_decoded)
+        if len(candidates) > num_results:
+            kth_score = self.get_kth_score((accumulators[d] for d in candidates), num_results)
+            candidates = [d for d in candidates if accumulators[d] >= self.get_prune_limit(kth_score)]
+        # the few documents left are rescored in term order so scores match score_all exactly
+        results = zip(candidates, self.score_documents(terms, candidates))
+        results = [(id, score) for id, score in results if score > 0 or not positive_only]
+        return heapq.nsmallest(num_results, results, key=lambda item: (-item[1], item[0]))
+
+
+class NumpyRanker(Ranker):
+    def __init__(self, num_pages, field_weights=None):
+        super().__init__(num_pages, 'numpy', field_weights)
+
+    def accumulate_scores(self, terms):
+        if not terms:
+            return np.empty(0, np.int64), np.empty(0)
+        ids = np.concatenate([term.postings.ids for term in terms])
+        # np.log can differ from math.log in the last bit, frequencies repeat a lot so the few distinct ones of
+        # each term are scored with term.score to keep scores identical to the python ranker
+        contributions = []
+        for term in terms:
+            unique_freqs, freq_index = np.unique(term.postings.freqs, return_inverse=True)
+            contributions.append(np.array([term.score(freq) for freq in unique_freqs.tolist()])[freq_index])
+        contributions = np.concatenate(contributions)
+        # bincount adds the weights in input order, which is term order, same as score_all
+        doc_ids, doc_index = np.unique(ids, return_inverse=True)
+        return doc_ids, np.bincount(doc_index, weights=contributions, minlength=len(doc_ids))
+
+    def score_all(self, terms):
+        doc_ids, scores = self.accumulate_scores(terms)
+        return defaultdict(float, zip(doc_ids.tolist(), scores.tolist()))
+
+    def top_k(self, terms, num_results, positive_only=False):
+        doc_ids, scores = self.accumulate_scores(terms)
+        if positive_only:
+            doc_ids, scores = doc_ids[scores > 0], scores[scores > 0]
+        if num_results <= 0:
+            return []
+        if len(scores) > num_results:
+            # every document tied with the k-th score is kept so ties are broken by doc id like the other rankers
+            kth_score = np.partition(scores, len(scores) - num_results)[len(scores) - num_results]
+            selected = np.flatnonzero(scores >= kth_score)
+            doc_ids, scores = doc_ids[selected], scores[selected]
+        order = np.lexsort((doc_ids, -scores))[:num_results]
+        return list(zip(doc_ids[order].tolist(), scores[order].tolist()))
+
 
 class QueryResults:
-    def __init__(self, file_traverser):
+    def __init__(self, file_traverser, postings_cache=None):
         self.file_traverser = file_traverser
+        self.postings_cache = postings_cache
+
+    def get_postings(self, token, field_name, file_num, line_num, lazy=False):
+        if self.postings_cache is None or line_num == '':
+            return self.fetch_postings(field_name, file_num, line_num, lazy)
+        # segments of one index can share a cache, so the key includes the index directory
+        key = (self.file_traverser.index_dir, field_name, token)
+        posting = self.postings_cache.get(key)
+        if posting is None:
+            posting = self.fetch_postings(field_name, file_num, line_num, lazy)
+            # lazy posting lists are not cached, the rankers other than conjunctive_top_k need them decoded
+            if not lazy or isinstance(posting, Postings):
+                self.postings_cache.put(key, posting, get_postings_size(posting))
+        return posting
+
+    def fetch_postings(self, field_name, file_num, line_num, lazy=False):
+        with metrics.timer('query.postings_fetch'):
+            return self.file_traverser.search_field_file(field_name, file_num, line_num, lazy)
+
+    def get_token_info(self, token):
+        with metrics.timer('query.dictionary_lookup'):
+            return self.file_traverser.get_token_info(token)
 
-    def simple_query(self, preprocessed_query):
+    def simple_query(self, preprocessed_query, lazy=False):
         page_freq, page_postings = {}, defaultdict(dict)
         for token in preprocessed_query:
-            token_info = self.file_traverser.get_token_info(token)
+            if self.file_traverser.impact_offsets is not None:
+                with metrics.timer('query.dictionary_lookup'):
+                    impact_pointer = self.file_traverser.get_impact_pointer(token)
+                if impact_pointer is None:
+                    continue
+                file_num, offset = impact_pointer
+                # tokens without an impact list, those in every page, fall back to their field lists
+                if offset:
+                    posting = self.get_postings(token, 'impact', file_num, offset)
+                    page_freq[token] = len(posting)
+                    page_postings[token]['impact'] = posting
+                    continue
+            token_info = self.get_token_info(token)
             if token_info:
                 file_num, freq, title_line, body_line, category_line, infobox_line, link_line, reference_line = token_info
                 line_map = {
@@ -94,15 +506,15 @@ class QueryResults:
                 }
                 for field_name, line_num in line_map.items():
                     if line_num != '':
-                        posting = self.file_traverser.search_field_file(field_name, file_num, line_num)
-                        page_freq[token] = len(posting.split(';'))
+                        posting = self.get_postings(token, field_name, file_num, line_num, lazy)
+                        page_freq[token] = len(posting)
                         page_postings[token][field_name] = posting
         return page_freq, page_postings
 
-    def field_query(self, preprocessed_query):
+    def field_query(self, preprocessed_query, lazy=False):
         page_freq, page_postings = {}, defaultdict(dict)
         for field, token in preprocessed_query:
-            token_info = self.file_traverser.get_token_info(token)
+            token_info = self.get_token_info(token)
             if token_info:
                 file_num, freq, title_line, body_line, category_line, infobox_line, link_line, reference_line = token_info
                 line_map = {
@@ -114,15 +526,195 @@ class QueryResults:
                 }
                 field_name = field_map[field]
                 line_num = line_map[field_name]
-                posting = self.file_traverser.search_field_file(field_name, file_num, line_num)
+                posting = self.get_postings(token, field_name, file_num, line_num, lazy)
                 page_freq[token] = len(posting)
                 page_postings[token][field_name] = posting
         return page_freq, page_postings
 
 
+class IndexSegment:
+    def __init__(self, index_dir, base, num_pages, use_numpy=False):
+        # impacts fold in the idfs of one segment, scores over segments need the idfs of all of them
+        self.file_traverser = FileTraverser(index_dir, use_numpy, use_impacts=False)
+        self.base = base
+        self.num_pages = num_pages
+        self.tombstones = read_tombstones(index_dir)
+        if self.tombstones is not None and use_numpy:
+            self.tombstones = np.frombuffer(self.tombstones, np.uint8)
+
+    def remove_deleted(self, postings):
+        if self.tombstones is None:
+            return postings
+        if isinstance(postings.ids, array):
+            ids, freqs = array('i'), array('i')
+            for id, freq in zip(postings.ids, postings.freqs):
+                if not is_deleted(self.tombstones, id - self.base):
+                    ids.append(id)
+                    freqs.append(freq)
+            return Postings(ids, freqs)
+        page_nums = postings.ids - self.base
+        live = (self.tombstones[page_nums >> 3] >> (page_nums & 7) & 1) == 0
+        return Postings(postings.ids[live], postings.freqs[live])
+
+
+def lock_live_segments(index_root):
+    # a shared lock on every live segment keeps compaction from deleting it while this searcher runs. The list is
+    # read again once the locks are held, a compaction in between means locking the new list instead
+    while True:
+        segments = read_segments(index_root)
+        if segments is None:
+            return None, []
+        lock_files = []
+        try:
+            for name, _, _ in segments:
+                if name != '.':
+                    lock_files.append(open(f'{index_root}{name}/{SEGMENT_LOCK_FILE}', 'a'))
+                    fcntl.flock(lock_files[-1], fcntl.LOCK_SH)
+        except FileNotFoundError:
+            pass
+        else:
+            if read_segments(index_root) == segments:
+                return segments, lock_files
+        for lock_file in lock_files:
+            lock_file.close()
+
+
+class SegmentedIndex:
+    def __init__(self, index_root, segments, use_numpy=False):
+        self.index_root = index_root
+        self.segments = [
+            IndexSegment(index_root if name == '.' else f'{index_root}{name}/', base, num_pages, use_numpy)
+            for name, base, num_pages in segments
+        ]
+        self.bases = [segment.base for segment in self.segments]
+        self.num_pages = sum(segment.num_pages for segment in self.segments)
+
+    def search_title(self, page_id):
+        segment = self.segments[bisect_right(self.bases, int(page_id)) - 1]
+        return segment.file_traverser.search_title(int(page_id) - segment.base)
+
+    def complete_title(self, prefix, num_results):
+        # every segment ranks its own titles, the static rank key orders titles of different segments the same way
+        results = [(segment.base + doc_id, title) for segment in self.segments
+                   for doc_id, title in segment.file_traverser.complete_title(prefix, num_results, segment.tombstones)]
+        return heapq.nsmallest(num_results, results, key=lambda result: get_title_rank_key(result[1].encode('utf-8'),
+                                                                                             result[0]))
+
+
+class SegmentedQueryResults:
+    def __init__(self, segmented_index, postings_cache=None):
+        self.segmented_index = segmented_index
+        self.segment_results = [QueryResults(segment.file_traverser, postings_cache)
+                                for segment in segmented_index.segments]
+
+    @property
+    def postings_cache(self):
+        return self.segment_results[0].postings_cache
+
+    @postings_cache.setter
+    def postings_cache(self, postings_cache):
+        for query_results in self.segment_results:
+            query_results.postings_cache = postings_cache
+
+    def merge_segment_results(self, query_type, preprocessed_query):
+        # doc ids are global and segments are in doc id order, so the live postings of each segment are
+        # concatenated
+        field_freqs, segment_postings = defaultdict(dict), defaultdict(dict)
+        for segment, query_results in zip(self.segmented_index.segments, self.segment_results):
+            if query_type == 'field':
+                _, page_postings = query_results.field_query(preprocessed_query)
+            else:
+                _, page_postings = query_results.simple_query(preprocessed_query)
+            for token, field_post_dict in page_postings.items():
+                for field, postings in field_post_dict.items():
+                    field_freqs[token][field] = field_freqs[token].get(field, 0) + len(postings)
+                    segment_postings[token].setdefault(field, []).append(segment.remove_deleted(postings))
+        # counts are summed over segments so dfs match a single index
+        page_freq = get_page_freq(query_type, preprocessed_query, field_freqs)
+        page_postings = defaultdict(dict)
+        for token, field_post_dict in segment_postings.items():
+            for field, postings_list in field_post_dict.items():
+                page_postings[token][field] = concatenate_postings(postings_list)
+        return page_freq, page_postings
+
+    # tombstones are applied to whole posting lists, so segments always decode them
+    def simple_query(self, preprocessed_query, lazy=False):
+        return self.merge_segment_results('simple', preprocessed_query)
+
+    def field_query(self, preprocessed_query, lazy=False):
+        return self.merge_segment_results('field', preprocessed_query)
+
+
+def get_page_freq(query_type, preprocessed_query, field_freqs):
+    # the df of a token is the posting count of its last field, the last non-empty one for simple queries and
+    # the last one asked for in field queries
+    page_freq = {}
+    if query_type == 'field':
+        field_names = dict(zip('tbcilr', FIELDS))
+        for field, token in preprocessed_query:
+            if token in field_freqs:
+                page_freq[token] = field_freqs[token].get(field_names[field], 0)
+    else:
+        for token, freqs in field_freqs.items():
+            page_freq[token] = [freqs[field] for field in FIELDS if freqs.get(field)][-1]
+    return page_freq
+
+
+class ShardQueryResults(QueryResults):
+    def __init__(self, file_traverser, global_dictionary, postings_cache=None):
+        super().__init__(file_traverser, postings_cache)
+        self.global_dictionary = global_dictionary
+
+    def get_global_freqs(self, page_postings):
+        # a shard only holds part of each posting list, dfs come from the counts of the whole index
+        field_freqs = {}
+        for token in page_postings:
+            _, _, _, counts = self.global_dictionary.lookup(token)
+            field_freqs[token] = dict(zip(FIELDS, counts))
+        return field_freqs
+
+    def simple_query(self, preprocessed_query, lazy=False):
+        _, page_postings = super().simple_query(preprocessed_query, lazy)
+        return get_page_freq('simple', preprocessed_query, self.get_global_freqs(page_postings)), page_postings
+
+    def field_query(self, preprocessed_query, lazy=False):
+        _, page_postings = super().field_query(preprocessed_query, lazy)
+        return get_page_freq('field', preprocessed_query, self.get_global_freqs(page_postings)), page_postings
+
+
+def concatenate_postings(postings_list):
+    if len(postings_list) == 1:
+        return postings_list[0]
+    if isinstance(postings_list[0].ids, array):
+        ids, freqs = array('i'), array('i')
+        for postings in postings_list:
+            ids.extend(postings.ids)
+            freqs.extend(postings.freqs)
+        return Postings(ids, freqs)
+    return Postings(np.concatenate([postings.ids for postings in postings_list]),
+                    np.concatenate([postings.freqs for postings in postings_list]))
+
+
+batch_run_query = None
+
+
+def rank_batch_query(key):
+    s = time.time()
+    results = batch_run_query.search_key(key)
+    results = [(id, batch_run_query.get_title(id)) for id, _ in results]
+    # worker timings travel back with the results, they are traced per query and added to the parent's totals
+    return results, time.time() - s, metrics.take() if metrics.enabled else None
+
+
+def write_query_trace(trace_file, query, key, results, seconds, stages):
+    trace_file.write(json.dumps({'query': query, 'type': key[0], 'num_results': len(results) if results else 0,
+                                 'seconds': seconds, 'stages': stages}) + '\n')
+
+
 class RunQuery:
-    def __init__(self, text_pre_processor, file_traverser, ranker, query_results):
+    def __init__(self, text_pre_processor, file_traverser, ranker, query_results, result_cache=None):
         self.file_traverser = file_traverser
+        self.result_cache = result_cache
         self.text_pre_processor = text_pre_processor
         self.ranker = ranker
         self.query_results = query_results
@@ -154,136 +746,466 @@ class RunQuery:
         else:
             return query, None
 
-    def return_query_results(self, query, query_type):
+    def preprocess_query(self, query, query_type):
         if query_type == 'field':
             preprocessed_query = [[qry.split(':')[0], self.text_pre_processor.preprocess_text(qry.split(':')[1])] for
                                   qry in query]
-        else:
-            preprocessed_query = self.text_pre_processor.preprocess_text(query)
-        if query_type == 'field':
             preprocessed_query_final = []
             for field, words in preprocessed_query:
                 for word in words:
-                    preprocessed_query_final.append([field, word])
-            page_freq, page_postings = self.query_results.field_query(preprocessed_query_final)
+                    preprocessed_query_final.append((field, word))
+            return tuple(preprocessed_query_final)
+        # +word makes the tokens of word required, they are kept in the query with a leading +
+        words = query.split()
+        required = ' '.join(word[1:] for word in words if word.startswith('+'))
+        if not required:
+            return tuple(self.text_pre_processor.preprocess_text(query))
+        optional = ' '.join(word for word in words if not word.startswith('+'))
+        return tuple(self.text_pre_processor.preprocess_text(optional)) + tuple(
+            '+' + token for token in self.text_pre_processor.preprocess_text(required))
+
+    def get_preprocessed_terms(self, preprocessed_query, query_type, lazy=False):
+        if query_type == 'field':
+            page_freq, page_postings = self.query_results.field_query(preprocessed_query, lazy)
         else:
-            page_freq, page_postings = self.query_results.simple_query(preprocessed_query)
-        ranked_results = self.ranker.do_ranking(page_freq, page_postings)
-        return ranked_results
+            page_freq, page_postings = self.query_results.simple_query(preprocessed_query, lazy)
+        with metrics.timer('query.rank'):
+            return self.ranker.get_scoring_terms(page_freq, page_postings)
 
-    def take_input_from_file(self, file_name, num_results):
+    def get_query_key(self, query, num_results):
+        with metrics.timer('query.preprocess'):
+            query1, query2 = self.identify_query_type(query)
+            # the key is the preprocessed query, so queries that only differ in case, stop words or inflections
+            # share a cache entry
+            if query2:
+                key = ('mixed', self.preprocess_query(query1, 'simple'), self.preprocess_query(query2, 'field'))
+            elif type(query1) == type([]):
+                key = ('field', (), self.preprocess_query(query1, 'field'))
+            else:
+                key = ('simple', self.preprocess_query(query1, 'simple'), ())
+        return key + (num_results,)
+
+    def search(self, query, num_results):
+        return self.search_key(self.get_query_key(query, num_results))
+
+    def search_key(self, key):
+        metrics.count('query.queries')
+        if self.result_cache is not None:
+            results = self.result_cache.get(key)
+            if results is not None:
+                return results
+        query_type, simple_query, field_query, num_results = key
+        if any(token.startswith('+') for token in simple_query):
+            results = self.conjunctive_search(simple_query, field_query, num_results, query_type == 'mixed')
+            if self.result_cache is not None:
+                self.result_cache.put(key, results, get_results_size(key, results))
+            return results
+        # maxscore decodes only the blocks it cannot skip, the other rankers need every posting
+        lazy = self.ranker.ranking == 'maxscore'
+        if query_type == 'mixed':
+            terms = (self.get_preprocessed_terms(simple_query, 'simple', lazy)
+                     + self.get_preprocessed_terms(field_query, 'field', lazy))
+        elif query_type == 'field':
+            terms = self.get_preprocessed_terms(field_query, 'field', lazy)
+        else:
+            terms = self.get_preprocessed_terms(simple_query, 'simple', lazy)
+        with metrics.timer('query.rank'):
+            # simple and field scores used to be summed with Counter, which drops totals that are not positive
+            results = self.ranker.top_k(terms, num_results, positive_only=query_type == 'mixed')
+        if self.result_cache is not None:
+            self.result_cache.put(key, results, get_results_size(key, results))
+        return results
+
+    def conjunctive_search(self, simple_query, field_query, num_results, positive_only):
+        required_tokens = [token[1:] for token in simple_query if token.startswith('+')]
+        simple_query = tuple(dict.fromkeys(token.lstrip('+') for token in simple_query))
+        page_freq, page_postings = self.query_results.simple_query(simple_query, lazy=True)
+        with metrics.timer('query.rank'):
+            terms = self.ranker.get_scoring_terms(page_freq, page_postings)
+        if field_query:
+            page_freq, field_postings = self.query_results.field_query(field_query, lazy=True)
+            with metrics.timer('query.rank'):
+                terms += self.ranker.get_scoring_terms(page_freq, field_postings)
+        required = [list(page_postings.get(token, {}).values()) for token in required_tokens]
+        with metrics.timer('query.rank'):
+            return self.ranker.conjunctive_top_k(terms, required, num_results, positive_only)
+
+    def prefetch_postings(self, keys):
+        simple_tokens, field_tokens = set(), set()
+        for _, simple_query, field_query, _ in keys:
+            simple_tokens.update(token.lstrip('+') for token in simple_query)
+            field_tokens.update(field_query)
+        # sorted tokens read the postings files roughly front to back
+        self.query_results.simple_query(sorted(simple_tokens))
+        self.query_results.field_query(sorted(field_tokens, key=lambda field_token: field_token[1]))
+
+    def get_title(self, page_id):
+        with metrics.timer('query.title_lookup'):
+            return self.file_traverser.search_title(page_id)
+
+    def complete(self, prefix, num_results):
+        # (doc id, normalized title) pairs of the best ranked titles starting with prefix
+        with metrics.timer('query.complete'):
+            return self.file_traverser.complete_title(prefix, num_results)
+
+    def warm_caches(self, file_name, num_results):
+        with open(file_name, 'r') as f:
+            for query in f:
+                query = query.strip()
+                if query:
+                    self.search(query, num_results)
+
+    def print_cache_stats(self):
+        if self.result_cache is not None:
+            print('Result cache:', self.result_cache.get_stats())
+        if self.query_results is not None and self.query_results.postings_cache is not None:
+            print('Postings cache:', self.query_results.postings_cache.get_stats())
+
+    def take_input_from_file(self, file_name, num_results, trace_file=None):
         results_file = file_name.split('.txt')[0]
         with open(file_name, 'r') as f:
             fp = open(results_file + '_op.txt', 'w')
             for i, query in enumerate(f):
+                before = metrics.snapshot() if trace_file is not None else None
                 s = time.time()
                 query = query.strip()
-                query1, query2 = self.identify_query_type(query)
-                if query2:
-                    ranked_results1 = self.return_query_results(query1, 'simple')
-                    ranked_results2 = self.return_query_results(query2, 'field')
-                    ranked_results = Counter(ranked_results1) + Counter(ranked_results2)
-                    results = sorted(ranked_results.items(), key=lambda item: item[1], reverse=True)
-                    results = results[:num_results]
-                    if results:
-                        for id, _ in results:
-                            title = self.file_traverser.search_title(id)
-                            fp.write(id + ', ' + title)
-                            fp.write('\n')
-                    else:
-                        fp.write('No matching document found')
-                        fp.write('\n')
-                elif type(query1) == type([]):
-                    ranked_results = self.return_query_results(query1, 'field')
-                    results = sorted(ranked_results.items(), key=lambda item: item[1], reverse=True)
-                    results = results[:num_results]
-                    if results:
-                        for id, _ in results:
-                            title = self.file_traverser.search_title(id)
-                            fp.write(id + ', ' + title)
-                            fp.write('\n')
-                    else:
-                        fp.write('No matching document found')
+                key = self.get_query_key(query, num_results)
+                results = self.search_key(key)
+                if results:
+                    for id, _ in results:
+                        title = self.get_title(id)
+                        fp.write(str(id) + ', ' + title)
                         fp.write('\n')
                 else:
-                    ranked_results = self.return_query_results(query1, 'simple')
-                    results = sorted(ranked_results.items(), key=lambda item: item[1], reverse=True)
-                    results = results[:num_results]
-                    if results:
-                        for id, _ in results:
-                            title = self.file_traverser.search_title(id)
-                            fp.write(id + ', ' + title)
-                            fp.write('\n')
-                    else:
-                        fp.write('No matching document found')
-                        fp.write('\n')
+                    fp.write('No matching document found')
+                    fp.write('\n')
                 e = time.time()
                 fp.write('Finished in ' + str(e - s) + ' seconds')
                 fp.write('\n\n')
+                if trace_file is not None:
+                    write_query_trace(trace_file, query, key, results, e - s, metrics.get_stage_seconds(before))
                 print('Done query', i + 1)
             fp.close()
         print('Done writing results')
 
+    def take_input_from_file_batch(self, file_name, num_results, num_workers, trace_file=None):
+        global batch_run_query
+        start = time.time()
+        results_file = file_name.split('.txt')[0]
+        with open(file_name, 'r') as f:
+            queries = [query.strip() for query in f]
+        keys = [self.get_query_key(query, num_results) for query in queries]
+        distinct_keys = list(dict.fromkeys(keys))
+        self.prefetch_postings(distinct_keys)
+        print(f'Preprocessed {len(queries)} queries ({len(distinct_keys)} distinct) and fetched their postings in',
+              time.time() - start, 'seconds')
+        # the workers are forked after the prefetch, so they share the postings cache and the mmapped index files
+        batch_run_query = self
+        # multiprocessing takes a good part of the startup time, only batch mode and sharded indexes import it
+        import multiprocessing
+        with multiprocessing.Pool(num_workers, initializer=metrics.reset) as pool:
+            batch_results = dict(zip(distinct_keys, pool.imap(rank_batch_query, distinct_keys, chunksize=16)))
+        for _, _, worker_metrics in batch_results.values():
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+        with open(results_file + '_op.txt', 'w') as fp:
+            for query, key in zip(queries, keys):
+                results, query_time, worker_metrics = batch_results[key]
+                if results:
+                    for id, title in results:
+                        fp.write(str(id) + ', ' + title)
+                        fp.write('\n')
+                else:
+                    fp.write('No matching document found')
+                    fp.write('\n')
+                fp.write('Finished in ' + str(query_time) + ' seconds')
+                fp.write('\n\n')
+                if trace_file is not None:
+                    write_query_trace(trace_file, query, key, results, query_time,
+                                      {name: timer['seconds'] for name, timer in worker_metrics['timers'].items()})
+        total_time = time.time() - start
+        print('Done writing results')
+        print(f'Ran {len(queries)} queries in {total_time:.2f} seconds ({len(queries) / total_time:.1f} queries/s)')
+
     def take_input_from_user(self, num_results):
         start = time.time()
         while True:
             query = input('Enter Query:- ')
             s = time.time()
             query = query.strip()
-            query1, query2 = self.identify_query_type(query)
-            if query2:
-                ranked_results1 = self.return_query_results(query1, 'simple')
-                ranked_results2 = self.return_query_results(query2, 'field')
-                ranked_results = Counter(ranked_results1) + Counter(ranked_results2)
-                results = sorted(ranked_results.items(), key=lambda item: item[1], reverse=True)
-                results = results[:num_results]
-                for id, _ in results:
-                    title = self.file_traverser.search_title(id)
-                    print(id + ',', title)
-            elif type(query1) == type([]):
-                ranked_results = self.return_query_results(query1, 'field')
-                results = sorted(ranked_results.items(), key=lambda item: item[1], reverse=True)
-                results = results[:num_results]
-                for id, _ in results:
-                    title = self.file_traverser.search_title(id)
-                    print(id + ',', title)
-            else:
-                ranked_results = self.return_query_results(query1, 'simple')
-                results = sorted(ranked_results.items(), key=lambda item: item[1], reverse=True)
-                results = results[:num_results]
-                for id, _ in results:
-                    title = self.file_traverser.search_title(id)
-                    print(id + ',', title)
+            results = self.search(query, num_results)
+            for id, _ in results:
+                title = self.get_title(id)
+                print(str(id) + ',', title)
             e = time.time()
             print('Finished in', e - s, 'seconds')
             print()
 
 
+class ShardServer:
+    def __init__(self, run_query, base):
+        self.run_query = run_query
+        self.base = base
+
+    def handle_connection(self, conn):
+        # requests are ('search', query key) for the shard's top k with titles, or ('title', doc id)
+        try:
+            while True:
+                request, arg = conn.recv()
+                if request == 'search':
+                    results = self.run_query.search_key(arg)
+                    conn.send([(id, score, self.run_query.get_title(id - self.base)) for id, score in results])
+                elif request == 'title':
+                    conn.send(self.run_query.get_title(arg - self.base))
+        except EOFError:
+            pass
+        finally:
+            conn.close()
+
+    def serve(self, listener):
+        from multiprocessing import AuthenticationError
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError):
+                # a client with the wrong key, or one that hung up during the handshake, is dropped
+                continue
+            threading.Thread(target=self.handle_connection, args=(conn,), daemon=True).start()
+
+
+def get_index_manifest(index_root, segments=None):
+    # a segmented index built without a full dump has no manifest at its root, its segments share their settings
+    manifest = read_manifest(index_root)
+    if manifest is None and segments:
+        name = segments[0][0]
+        manifest = read_manifest(index_root if name == '.' else f'{index_root}{name}/')
+    return manifest
+
+
+def get_num_pages(index_dir, manifest):
+    if manifest is not None:
+        return float(manifest['num_pages'])
+    with open(index_dir + 'num_pages.txt', 'r') as f:
+        return float(f.readline().strip())
+
+
+def get_stop_words(manifest):
+    if manifest is not None:
+        return set(manifest['stop_words'])
+    # nltk takes longer to import than the whole searcher, it is only needed for indexes without a manifest
+    from nltk.corpus import stopwords
+    return set(stopwords.words(stemmer_language))
+
+
+def run_shard_server(index_root, shard, ranking, postings_cache_size, result_cache_size, address, authkey,
+                     address_conn=None):
+    metrics.reset()
+    name, base, _ = shard
+    use_numpy = ranking == 'numpy'
+    file_traverser = FileTraverser(f'{index_root}{name}/', use_numpy)
+    manifest = read_manifest(index_root)
+    num_pages = get_num_pages(index_root, manifest)
+    field_weights = manifest['field_weights'] if manifest is not None else None
+    ranker = NumpyRanker(num_pages, field_weights) if use_numpy else Ranker(num_pages, ranking, field_weights)
+    postings_cache = LRUCache(postings_cache_size) if postings_cache_size > 0 else None
+    result_cache = LRUCache(result_cache_size) if result_cache_size > 0 else None
+    query_results = ShardQueryResults(file_traverser, TermDictionary(index_root + 'tokens_dict.bin'), postings_cache)
+    # queries arrive preprocessed, shard workers need no pre-processor
+    run_query = RunQuery(None, file_traverser, ranker, query_results, result_cache)
+    from multiprocessing.connection import Listener
+    listener = Listener(address, authkey=authkey)
+    if address_conn is not None:
+        address_conn.send(listener.address)
+        address_conn.close()
+    else:
+        print(f'Serving {name} on {listener.address[0]}:{listener.address[1]}')
+    ShardServer(run_query, base).serve(listener)
+
+
+class ShardedRunQuery(RunQuery):
+    def __init__(self, text_pre_processor, shards, shard_addresses, authkey, result_cache=None, title_prefixes=None):
+        super().__init__(text_pre_processor, None, None, None, result_cache)
+        # the root of a sharded index keeps the titles of every shard, so titles are completed without the shards
+        self.title_prefixes = title_prefixes
+        self.shard_bases = [base for _, base, _ in shards]
+        self.shard_addresses = shard_addresses
+        self.authkey = authkey
+        self.connections = None
+        self.connections_pid = None
+        self.titles = {}
+
+    def get_connections(self):
+        # connections are opened lazily and again after a fork, so batch workers get their own
+        if self.connections_pid != os.getpid():
+            from multiprocessing.connection import Client
+            self.connections = [Client(address, authkey=self.authkey) for address in self.shard_addresses]
+            self.connections_pid = os.getpid()
+        return self.connections
+
+    def search_key(self, key):
+        if self.result_cache is not None:
+            results = self.result_cache.get(key)
+            if results is not None:
+                return results
+        connections = self.get_connections()
+        # every shard ranks its own doc id range with global dfs, so shard scores are final and only the
+        # top k lists are merged
+        for conn in connections:
+            conn.send(('search', key))
+        shard_results = [conn.recv() for conn in connections]
+        results = heapq.nsmallest(key[-1], (result for results in shard_results for result in results),
+                                  key=lambda item: (-item[1], item[0]))
+        if len(self.titles) > 100000:
+            self.titles = {}
+        self.titles.update((id, title) for id, _, title in results)
+        results = [(id, score) for id, score, _ in results]
+        if self.result_cache is not None:
+            self.result_cache.put(key, results, get_results_size(key, results))
+        return results
+
+    def get_title(self, page_id):
+        title = self.titles.get(page_id)
+        if title is None:
+            conn = self.get_connections()[bisect_right(self.shard_bases, page_id) - 1]
+            conn.send(('title', page_id))
+            title = conn.recv()
+        return title
+
+    def complete(self, prefix, num_results):
+        if self.title_prefixes is None:
+            raise ValueError('the index has no title_prefixes.bin, rebuild it to complete titles')
+        with metrics.timer('query.complete'):
+            return self.title_prefixes.complete(prefix, num_results)
+
+    def prefetch_postings(self, keys):
+        pass
+
+
 if __name__ == '__main__':
     start = time.time()
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('--filename', action='store', type=str)
     arg_parser.add_argument('--num_results', action='store', default=10, type=int)
+    arg_parser.add_argument('--ranker', action='store', default='exhaustive', choices=['exhaustive', 'maxscore', 'numpy'])
+    arg_parser.add_argument('--result-cache-size', action='store', default='16M', type=str)
+    arg_parser.add_argument('--postings-cache-size', action='store', default='64M', type=str)
+    arg_parser.add_argument('--exact-scores', action='store_true')
+    arg_parser.add_argument('--complete', action='store', type=str)
+    arg_parser.add_argument('--warm-queries', action='store', type=str)
+    arg_parser.add_argument('--batch-workers', action='store', default=0, type=int)
+    arg_parser.add_argument('--batch-prefetch-size', action='store', default='2G', type=str)
+    arg_parser.add_argument('--serve', action='store_true')
+    arg_parser.add_argument('--host', action='store', default='127.0.0.1', type=str)
+    arg_parser.add_argument('--port', action='store', default=8080, type=int)
+    arg_parser.add_argument('--server-workers', action='store', default=4, type=int)
+    arg_parser.add_argument('--max-in-flight', action='store', default=64, type=int)
+    arg_parser.add_argument('--shard-server', action='store', type=str)
+    arg_parser.add_argument('--shard-addresses', action='store', type=str)
+    arg_parser.add_argument('--shard-authkey', action='store', type=str)
+    arg_parser.add_argument('--metrics-file', action='store', type=str)
+    arg_parser.add_argument('--metrics-format', action='store', default='json', choices=['json', 'prometheus'])
+    arg_parser.add_argument('--metrics-interval', action='store', default=10.0, type=float)
+    arg_parser.add_argument('--query-trace', action='store', type=str)
     args = arg_parser.parse_args()
+    if args.ranker == 'numpy' and np is None:
+        arg_parser.error('--ranker numpy needs numpy installed')
+    result_cache_size, postings_cache_size = parse_size(args.result_cache_size), parse_size(args.postings_cache_size)
+    if args.metrics_file is not None:
+        metrics.start_exporter(args.metrics_file, args.metrics_format, args.metrics_interval)
+    # the per query trace is built from the stage timers
+    metrics.enabled = metrics.enabled or args.query_trace is not None
+    shards = read_segments('../wiki_index/', SHARDS_FILE)
+    if (args.shard_server is not None or args.shard_addresses is not None) and args.shard_authkey is None:
+        # connections unpickle what the other side sends, the key is all that keeps others from running code
+        arg_parser.error('--shard-server and --shard-addresses need a --shard-authkey')
+    # local shard workers are forked with a fresh random key
+    authkey = args.shard_authkey.encode('utf-8') if args.shard_authkey is not None else os.urandom(32)
+    if args.shard_server is not None:
+        shard = [shard for shard in shards or [] if shard[0] == args.shard_server]
+        if not shard:
+            arg_parser.error(f'no shard named {args.shard_server} in ../wiki_index/{SHARDS_FILE}')
+        run_shard_server('../wiki_index/', shard[0], args.ranker, postings_cache_size, 0, (args.host, args.port),
+                         authkey)
     file_name = args.filename
     num_results = args.num_results
     print('Loading search engine...')
-    stop_words = (set(stopwords.words("english")))
-    html_tags = re.compile('&amp;|&apos;|&gt;|&lt;|&nbsp;|&quot;')
-    stemmer = Stemmer('english')
-    with open('../wiki_index/num_pages.txt', 'r') as f:
-        num_pages = float(f.readline().strip())
+    segments, segment_locks = lock_live_segments('../wiki_index/') if shards is None else (None, [])
+    manifest = get_index_manifest('../wiki_index/', segments)
+    stop_words = get_stop_words(manifest)
+    language = manifest['stemmer_language'] if manifest is not None else stemmer_language
+    field_weights = manifest['field_weights'] if manifest is not None else None
+    stemmer = Stemmer(language)
     text_pre_processor = TextPreProcessor(html_tags, stemmer, stop_words)
-    file_traverser = FileTraverser()
-    ranker = Ranker(num_pages)
-    query_results = QueryResults(file_traverser)
-    run_query = RunQuery(text_pre_processor, file_traverser, ranker, query_results)
-    temp = linecache.getline('../wiki_index/id_title_map.txt', 0)
+    postings_cache = LRUCache(postings_cache_size) if postings_cache_size > 0 else None
+    result_cache = LRUCache(result_cache_size) if result_cache_size > 0 else None
+    if shards is not None:
+        if args.shard_addresses is not None:
+            shard_addresses = [(address.rsplit(':', 1)[0], int(address.rsplit(':', 1)[1]))
+                               for address in args.shard_addresses.split(',')]
+            if len(shard_addresses) != len(shards):
+                arg_parser.error(f'--shard-addresses needs one address for each of the {len(shards)} shards')
+        else:
+            # without remote shard servers every shard gets a local worker process on a free localhost port
+            import multiprocessing
+            shard_addresses = []
+            for shard in shards:
+                address_conn, child_conn = multiprocessing.Pipe()
+                multiprocessing.Process(target=run_shard_server, daemon=True, args=(
+                    '../wiki_index/', shard, args.ranker, postings_cache_size, 0, ('127.0.0.1', 0), authkey,
+                    child_conn)).start()
+                shard_addresses.append(address_conn.recv())
+        file_traverser, query_results = None, None
+        title_prefixes = None
+        if os.path.exists('../wiki_index/title_prefixes.bin'):
+            title_prefixes = TitlePrefixes('../wiki_index/title_prefixes.bin')
+        run_query = ShardedRunQuery(text_pre_processor, shards, shard_addresses, authkey, result_cache, title_prefixes)
+        make_run_query = lambda: ShardedRunQuery(TextPreProcessor(html_tags, Stemmer(language), stop_words),
+                                                 shards, shard_addresses, authkey, result_cache, title_prefixes)
+    else:
+        if segments is None:
+            num_pages = get_num_pages('../wiki_index/', manifest)
+            file_traverser = FileTraverser(use_numpy=args.ranker == 'numpy', use_impacts=not args.exact_scores)
+            query_results = QueryResults(file_traverser, postings_cache)
+        else:
+            file_traverser = SegmentedIndex('../wiki_index/', segments, use_numpy=args.ranker == 'numpy')
+            num_pages = float(file_traverser.num_pages)
+            query_results = SegmentedQueryResults(file_traverser, postings_cache)
+        if args.ranker == 'numpy':
+            ranker = NumpyRanker(num_pages, field_weights)
+        else:
+            ranker = Ranker(num_pages, args.ranker, field_weights)
+        run_query = RunQuery(text_pre_processor, file_traverser, ranker, query_results, result_cache)
+        make_run_query = lambda: RunQuery(TextPreProcessor(html_tags, Stemmer(language), stop_words),
+                                          file_traverser, ranker, query_results, result_cache)
+    if args.warm_queries is not None:
+        run_query.warm_caches(args.warm_queries, num_results)
+        run_query.print_cache_stats()
+    if isinstance(file_traverser, FileTraverser) and file_traverser.title_store is None:
+        temp = linecache.getline('../wiki_index/id_title_map.txt', 0)
     print('Loaded in', time.time() - start, 'seconds')
     print('Starting Querying')
     start = time.time()
-    if file_name is not None:
-        run_query.take_input_from_file(file_name, num_results)
+    if args.serve:
+        from query_server import QueryServer
+        server = QueryServer(make_run_query, args.server_workers, args.max_in_flight)
+        server.serve(args.host, args.port)
+    elif args.complete is not None:
+        s = time.time()
+        for id, title in run_query.complete(args.complete, num_results):
+            print(str(id) + ',', title)
+        print('Finished in', time.time() - s, 'seconds')
+    elif file_name is not None:
+        trace_file = open(args.query_trace, 'w', encoding="utf-8") if args.query_trace is not None else None
+        if args.batch_workers > 0:
+            if query_results is not None:
+                query_results.postings_cache = LRUCache(parse_size(args.batch_prefetch_size))
+            run_query.take_input_from_file_batch(file_name, num_results, args.batch_workers, trace_file)
+        else:
+            run_query.take_input_from_file(file_name, num_results, trace_file)
+        if trace_file is not None:
+            trace_file.close()
     else:
         run_query.take_input_from_user(num_results)
     print('Done querying in', time.time() - start, 'seconds')
+    run_query.print_cache_stats()
+    metrics.stop_exporter()
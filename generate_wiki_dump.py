@@ -0,0 +1,186 @@
+import argparse
+import bz2
+import random
+from itertools import accumulate
+from xml.sax.saxutils import escape
+
+
+class WikiDumpGenerator():
+    def __init__(self, seed=1, vocab_size=50000, zipf_exponent=1.07):
+        self.random = random.Random(seed)
+        self.vocabulary = self.make_vocabulary(vocab_size)
+        # word ranks follow a Zipf distribution like natural text, so a few words make up most of the tokens
+        self.cum_weights = list(accumulate(1.0 / (rank + 1) ** zipf_exponent for rank in range(vocab_size)))
+        self.infobox_types = self.words(20)
+        self.infobox_keys = self.words(40)
+        self.domains = [word + suffix for word in self.words(30) for suffix in ['.com', '.org']]
+
+    def make_vocabulary(self, vocab_size):
+        syllables = [c + v for c in 'bcdfghjklmnprstvwz' for v in 'aeiou'] + ['th', 'st', 'er', 'an', 'on', 'in']
+        vocabulary = set()
+        while len(vocabulary) < vocab_size:
+            if self.random.random() < 0.03:
+                vocabulary.add(str(self.random.randint(1, 2030)))
+            else:
+                vocabulary.add(''.join(self.random.choices(syllables, k=self.random.randint(1, 4))))
+        vocabulary = sorted(vocabulary)
+        self.random.shuffle(vocabulary)
+        return vocabulary
+
+    def words(self, k):
+        return self.random.choices(self.vocabulary, cum_weights=self.cum_weights, k=k)
+
+    def sentence(self, min_words, max_words):
+        return ' '.join(self.words(self.random.randint(min_words, max_words)))
+
+    def url(self):
+        return f'http://www.{self.random.choice(self.domains)}/{"/".join(self.words(2))}'
+
+    def make_infobox(self):
+        lines = ['{{Infobox ' + self.random.choice(self.infobox_types)]
+        for key in self.random.sample(self.infobox_keys, self.random.randint(2, 10)):
+            value = self.sentence(1, 5)
+            if self.random.random() < 0.2:
+                value = '{{birth date|' + '|'.join(str(self.random.randint(1, 28)) for _ in range(3)) + '}} ' + value
+            elif self.random.random() < 0.3:
+                value = f'[[{value}]]'
+            lines.append(f'| {key} = {value}')
+        lines.append('}}')
+        return lines
+
+    def make_paragraph(self):
+        parts = []
+        for _ in range(self.random.randint(2, 8)):
+            sentence = self.sentence(5, 25)
+            r = self.random.random()
+            if r < 0.3:
+                link = self.sentence(1, 3)
+                sentence += f' [[{link}|{self.sentence(1, 3)}]]'
+            elif r < 0.45:
+                sentence += f'<ref>{{{{cite web |url={self.url()} |title={self.sentence(2, 6)}}}}}</ref>'
+            elif r < 0.5:
+                sentence += f" '''{self.sentence(1, 2)}''' &amp; {self.sentence(1, 3)}"
+            parts.append(sentence + '.')
+        return ' '.join(parts)
+
+    def make_page(self, title):
+        lines = []
+        if self.random.random() < 0.6:
+            lines.extend(self.make_infobox())
+        lines.append(f"'''{title}''' {self.make_paragraph()}")
+        lines.append('')
+        for _ in range(self.random.randint(0, 4)):
+            lines.append(f'=={self.sentence(1, 3).capitalize()}==')
+            for _ in range(self.random.randint(1, 3)):
+                lines.append(self.make_paragraph())
+                lines.append('')
+        lines.append('==References==')
+        lines.append('{{reflist}}')
+        for _ in range(self.random.randint(0, 5)):
+            lines.append(f'* {{{{cite book |title={self.sentence(2, 6)} |publisher={self.sentence(1, 2)}}}}} {self.url()}')
+        lines.append('')
+        if self.random.random() < 0.7:
+            lines.append('==External links==')
+            for _ in range(self.random.randint(1, 4)):
+                lines.append(f'* [{self.url()} {self.sentence(1, 5)}]')
+            lines.append('')
+        for _ in range(self.random.randint(0, 5)):
+            lines.append(f'[[Category:{self.sentence(1, 4).capitalize()}]]')
+        if self.random.random() < 0.1:
+            lines.append('{{' + self.random.choice(self.vocabulary) + '-stub}}')
+        return '\n'.join(lines)
+
+    def make_title(self):
+        return ' '.join(word.capitalize() for word in self.words(self.random.randint(1, 4)))
+
+    def make_page_xml(self, page_id):
+        title = self.make_title()
+        page = (f'  <page>\n    <title>{escape(title)}</title>\n    <ns>0</ns>\n    <id>{page_id}</id>\n'
+                f'    <revision>\n      <id>{page_id + 1000000}</id>\n'
+                f'      <text xml:space="preserve">{escape(self.make_page(title))}</text>\n'
+                f'    </revision>\n  </page>\n')
+        return title, page
+
+    def make_queries(self, num_queries):
+        queries = []
+        for _ in range(num_queries):
+            r = self.random.random()
+            if r < 0.6:
+                queries.append(' '.join(self.words(self.random.randint(1, 4))))
+            elif r < 0.9:
+                queries.append(' '.join(f'{self.random.choice("tbcilr")}:{word}'
+                                        for word in self.words(self.random.randint(1, 3))))
+            else:
+                queries.append(' '.join(self.words(2)) + f' {self.random.choice("tbcilr")}:{self.words(1)[0]}')
+        return queries
+
+    def write(self, file_name, num_pages=None, size=None, index_file_name=None, pages_per_stream=100):
+        # a multistream dump is a header stream, one bz2 stream per pages_per_stream pages and a footer stream,
+        # with an offset:page_id:title index of the page streams
+        header = ('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xml:lang="en">\n'
+                  '  <siteinfo>\n    <sitename>Wikipedia</sitename>\n  </siteinfo>\n')
+        footer = '</mediawiki>\n'
+        multistream = index_file_name is not None
+        if multistream:
+            out = open(file_name, 'wb')
+            index_file = bz2.open(index_file_name, 'wt', encoding="utf-8")
+            out.write(bz2.compress(header.encode('utf-8')))
+        elif file_name.endswith('.bz2'):
+            out = bz2.open(file_name, 'wt', encoding="utf-8")
+            out.write(header)
+        else:
+            out = open(file_name, 'w', encoding="utf-8")
+            out.write(header)
+        num_written = 0
+        num_bytes = len(header)
+        stream = []
+        while (num_pages is None or num_written < num_pages) and (size is None or num_bytes < size):
+            title, page = self.make_page_xml(num_written + 1)
+            num_written += 1
+            num_bytes += len(page.encode('utf-8'))
+            if multistream:
+                stream.append((num_written, title, page))
+                if len(stream) == pages_per_stream:
+                    self.write_stream(out, index_file, stream)
+                    stream = []
+            else:
+                out.write(page)
+        if multistream:
+            if stream:
+                self.write_stream(out, index_file, stream)
+            out.write(bz2.compress(footer.encode('utf-8')))
+            index_file.close()
+        else:
+            out.write(footer)
+        out.close()
+        return num_written, num_bytes + len(footer)
+
+    def write_stream(self, out, index_file, stream):
+        offset = out.tell()
+        for page_id, title, _ in stream:
+            index_file.write(f'{offset}:{page_id}:{title}\n')
+        out.write(bz2.compress(''.join(page for _, _, page in stream).encode('utf-8')))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('output', action='store', type=str)
+    arg_parser.add_argument('--pages', action='store', default=10000, type=int)
+    arg_parser.add_argument('--size-mb', action='store', type=float)
+    arg_parser.add_argument('--seed', action='store', default=1, type=int)
+    arg_parser.add_argument('--vocab-size', action='store', default=50000, type=int)
+    arg_parser.add_argument('--multistream-index', action='store', type=str)
+    arg_parser.add_argument('--queries', action='store', type=str)
+    arg_parser.add_argument('--num-queries', action='store', default=1000, type=int)
+    args = arg_parser.parse_args()
+    generator = WikiDumpGenerator(args.seed, args.vocab_size)
+    # --size-mb bounds the uncompressed xml instead of the page count
+    size = int(args.size_mb * 2 ** 20) if args.size_mb is not None else None
+    num_pages = None if size is not None else args.pages
+    num_written, num_bytes = generator.write(args.output, num_pages, size, args.multistream_index)
+    print(f'Wrote {num_written} pages ({num_bytes / 2 ** 20:.1f} MB uncompressed) to {args.output}')
+    if args.queries:
+        with open(args.queries, 'w', encoding="utf-8") as f:
+            f.write('\n'.join(generator.make_queries(args.num_queries)))
+            f.write('\n')
+        print(f'Wrote {args.num_queries} queries to {args.queries}')
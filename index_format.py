@@ -0,0 +1,596 @@
+import heapq
+import json
+import math
+import mmap
+import os
+import shutil
+import struct
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+from lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+
+# Binary postings files start with a magic and a version byte so they can live next to the text format.
+# Every posting list is: count, number of blocks, a (last doc id gap, max frequency, byte size) skip entry per
+# block of BLOCK_SIZE postings, then per block its doc id gaps followed by its frequencies, all variable-byte
+# encoded. A block can be decoded on its own from the skip entries.
+POSTINGS_MAGIC = b'WSEP'
+POSTINGS_VERSION = 3
+POSTINGS_HEADER = POSTINGS_MAGIC + bytes([POSTINGS_VERSION])
+BLOCK_SIZE = 128
+
+
+class Postings:
+    def __init__(self, ids, freqs, block_last_ids=None, block_max_freqs=None):
+        self.ids = ids
+        self.freqs = freqs
+        self.block_last_ids = block_last_ids
+        self.block_max_freqs = block_max_freqs
+        # impact lists set the scale, their freqs are quantized impacts
+        self.scale = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_block_maxes(self):
+        # text indexes carry no block table, so it is built from the decoded arrays
+        if self.block_last_ids is None:
+            self.block_last_ids, self.block_max_freqs = get_block_maxes(self.ids, self.freqs)
+        return self.block_last_ids, self.block_max_freqs
+
+    def get_block(self, block):
+        start = block * BLOCK_SIZE
+        return self.ids[start:start + BLOCK_SIZE], self.freqs[start:start + BLOCK_SIZE]
+
+
+class BlockPostings:
+    # a binary posting list of which only the skip entries are decoded, blocks are decoded when asked for
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.pos = pos
+        (self.count, num_blocks), pos = decode_varints(buf, pos, 2)
+        skips, pos = decode_varints(buf, pos, 3 * num_blocks)
+        self.block_last_ids = array('i', accumulate(skips[0::3]))
+        self.block_max_freqs = array('i', skips[1::3])
+        self.block_starts = list(accumulate(skips[2::3][:-1], initial=pos))
+        # rankers can come back to a block, each is decoded once
+        self.blocks = {}
+
+    def __len__(self):
+        return self.count
+
+    def get_block_maxes(self):
+        return self.block_last_ids, self.block_max_freqs
+
+    def get_block(self, block):
+        if block not in self.blocks:
+            size = min(BLOCK_SIZE, self.count - block * BLOCK_SIZE)
+            values, _ = decode_varints(self.buf, self.block_starts[block], 2 * size)
+            # the first gap of a block is taken from the last doc id of the block before
+            ids = array('i', accumulate(values[:size], initial=self.block_last_ids[block - 1] if block else 0))
+            self.blocks[block] = ids[1:], array('i', values[size:])
+        return self.blocks[block]
+
+    def decode(self):
+        # the whole list at once, cheaper than block by block when every posting is needed
+        return decode_postings(self.buf, self.pos)
+
+
+class PostingsCursor:
+    def __init__(self, postings):
+        self.postings = postings
+        self.block_last_ids = postings.get_block_maxes()[0]
+        self.block = -1
+        self.ids, self.freqs = None, None
+        self.i = 0
+        self.blocks_decoded = 0
+
+    def advance(self, doc_id):
+        # moves to the first doc id that is not below doc_id and returns it, None once the list is exhausted.
+        # Blocks whose last doc id is below doc_id are skipped without being decoded. The cursor never moves back,
+        # a doc_id below the current one returns the current one
+        if self.ids is None or self.ids[-1] < doc_id:
+            self.block = bisect_left(self.block_last_ids, doc_id, self.block + 1)
+            if self.block >= len(self.block_last_ids):
+                self.ids = None
+                return None
+            self.ids, self.freqs = self.postings.get_block(self.block)
+            self.blocks_decoded += 1
+            self.i = 0
+        self.i = bisect_left(self.ids, doc_id, self.i)
+        return self.ids[self.i]
+
+    def freq(self):
+        return self.freqs[self.i]
+
+
+def get_block_maxes(ids, freqs):
+    block_last_ids, block_max_freqs = array('i'), array('i')
+    for start in range(0, len(ids), BLOCK_SIZE):
+        block_last_ids.append(ids[min(start + BLOCK_SIZE, len(ids)) - 1])
+        block_max_freqs.append(max(freqs[start:start + BLOCK_SIZE]))
+    return block_last_ids, block_max_freqs
+
+
+def encode_varints(values, out):
+    for value in values:
+        while value >= 128:
+            out.append(value & 127 | 128)
+            value >>= 7
+        out.append(value)
+    return out
+
+
+def decode_varints(buf, pos, count):
+    values = []
+    value = shift = 0
+    while count:
+        byte = buf[pos]
+        pos += 1
+        if byte < 128:
+            values.append(value | byte << shift)
+            value = shift = 0
+            count -= 1
+        else:
+            value |= (byte & 127) << shift
+            shift += 7
+    return values, pos
+
+
+def delta_encode(values):
+    prev_value = 0
+    gaps = []
+    for value in values:
+        gaps.append(value - prev_value)
+        prev_value = value
+    return gaps
+
+
+def encode_postings(ids, freqs):
+    out = bytearray()
+    block_last_ids, block_max_freqs = get_block_maxes(ids, freqs)
+    gaps = delta_encode(ids)
+    blocks = [encode_varints(gaps[start:start + BLOCK_SIZE] + freqs[start:start + BLOCK_SIZE], bytearray())
+              for start in range(0, len(ids), BLOCK_SIZE)]
+    encode_varints([len(ids), len(block_last_ids)], out)
+    for last_id_gap, max_freq, block in zip(delta_encode(block_last_ids), block_max_freqs, blocks):
+        encode_varints([last_id_gap, max_freq, len(block)], out)
+    for block in blocks:
+        out += block
+    return bytes(out)
+
+
+def decode_postings(buf, pos):
+    (count, num_blocks), pos = decode_varints(buf, pos, 2)
+    skips, pos = decode_varints(buf, pos, 3 * num_blocks)
+    values, pos = decode_varints(buf, pos, 2 * count)
+    gaps, freqs = [], []
+    for start in range(0, count, BLOCK_SIZE):
+        size = min(BLOCK_SIZE, count - start)
+        gaps += values[2 * start:2 * start + size]
+        freqs += values[2 * start + size:2 * (start + size)]
+    return Postings(array('i', accumulate(gaps)), array('i', freqs), array('i', accumulate(skips[0::3])),
+                    array('i', skips[1::3]))
+
+
+def decode_postings_numpy(buf, pos):
+    (count, num_blocks), pos = decode_varints(buf, pos, 2)
+    num_values = 3 * num_blocks + 2 * count
+    # a u32 takes at most 5 bytes, the varints end at the first num_values bytes below 128
+    data = np.frombuffer(buf, np.uint8, min(5 * num_values, len(buf) - pos), pos)
+    ends = np.flatnonzero(data < 128)[:num_values]
+    starts = np.empty(num_values, np.int64)
+    starts[0], starts[1:] = 0, ends[:-1] + 1
+    data = data[:ends[-1] + 1]
+    shifts = 7 * (np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    values = np.add.reduceat((data & 127).astype(np.int64) << shifts, starts)
+    skips, values = values[:3 * num_blocks], values[3 * num_blocks:]
+    # full blocks are (gaps, freqs) pairs of BLOCK_SIZE values, the last block may be shorter
+    num_full = count // BLOCK_SIZE
+    full_blocks = values[:2 * BLOCK_SIZE * num_full].reshape(num_full, 2, BLOCK_SIZE)
+    last_block = values[2 * BLOCK_SIZE * num_full:]
+    last_size = count - BLOCK_SIZE * num_full
+    gaps = np.concatenate([full_blocks[:, 0].ravel(), last_block[:last_size]])
+    freqs = np.concatenate([full_blocks[:, 1].ravel(), last_block[last_size:]])
+    return Postings(np.cumsum(gaps), freqs, np.cumsum(skips[0::3]), skips[1::3])
+
+
+def open_postings_file(file_name):
+    with open(file_name, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:len(POSTINGS_MAGIC)] != POSTINGS_MAGIC:
+        raise ValueError(f'{file_name} is not a binary postings file')
+    if buf[len(POSTINGS_MAGIC)] != POSTINGS_VERSION:
+        raise ValueError(f'{file_name} has postings version {buf[len(POSTINGS_MAGIC)]}, '
+                         f'expected {POSTINGS_VERSION}, rebuild the index')
+    return buf
+
+
+# An impact list has one posting per page of a token, the page's score for a simple query of the token quantized
+# to 0..IMPACT_LEVELS. It is the scale (a little-endian double, negative for a negative idf) followed by a binary
+# posting list of the levels. impact_offsets.bin has the byte offset of every term's list in its impact_data file,
+# 0 for terms without one.
+IMPACT_SCALE = struct.Struct('<d')
+IMPACT_LEVELS = 255
+IMPACTS_MAGIC = b'WSEI'
+IMPACTS_VERSION = 1
+IMPACTS_HEADER = struct.Struct('<4sB3xQ')
+
+
+def encode_impacts(ids, impacts):
+    max_impact = max(abs(impact) for impact in impacts)
+    if not max_impact:
+        return IMPACT_SCALE.pack(0.0) + encode_postings(ids, [0] * len(ids))
+    step = max_impact / IMPACT_LEVELS
+    levels = [round(abs(impact) / step) for impact in impacts]
+    return IMPACT_SCALE.pack(math.copysign(step, impacts[0])) + encode_postings(ids, levels)
+
+
+def decode_impacts(buf, pos, use_numpy=False):
+    (scale,) = IMPACT_SCALE.unpack_from(buf, pos)
+    postings = (decode_postings_numpy if use_numpy else decode_postings)(buf, pos + IMPACT_SCALE.size)
+    postings.scale = scale
+    return postings
+
+
+def write_impact_offsets(file_name, offsets):
+    with open(file_name, 'wb') as f:
+        f.write(IMPACTS_HEADER.pack(IMPACTS_MAGIC, IMPACTS_VERSION, len(offsets)))
+        offsets.tofile(f)
+
+
+def read_impact_offsets(file_name):
+    with open(file_name, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, num_terms = IMPACTS_HEADER.unpack_from(buf, 0)
+    if magic != IMPACTS_MAGIC or version != IMPACTS_VERSION:
+        raise ValueError(f'{file_name} is not a version {IMPACTS_VERSION} impact offsets file, rebuild the index')
+    return memoryview(buf)[IMPACTS_HEADER.size:IMPACTS_HEADER.size + 8 * num_terms].cast('Q')
+
+
+# The term dictionary is a header, an offset table into the string pool, one fixed-width record per term
+# and the string pool of utf-8 tokens, all sorted by token so a lookup is a binary search over the mmap.
+TERMS_MAGIC = b'WSED'
+TERMS_VERSION = 1
+TERMS_HEADER = struct.Struct('<4sB3xQ')
+TERM_RECORD = struct.Struct('<II6Q6I')
+FIELDS = ['title', 'body', 'category', 'infobox', 'link', 'reference']
+FIELD_WEIGHTS = {'title': 1.0, 'body': 0.6, 'category': 0.4, 'infobox': 0.75, 'link': 0.20, 'reference': 0.25}
+
+
+class TermDictionaryWriter:
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.records = open(file_name + '.records', 'wb')
+        self.strings = open(file_name + '.strings', 'wb')
+        self.offsets = array('Q', [0])
+
+    def add(self, token, file_num, freq, pointers, counts):
+        token = token.encode('utf-8')
+        self.strings.write(token)
+        self.offsets.append(self.offsets[-1] + len(token))
+        self.records.write(TERM_RECORD.pack(file_num, freq, *pointers, *counts))
+
+    def close(self):
+        self.records.close()
+        self.strings.close()
+        with open(self.file_name, 'wb') as f:
+            f.write(TERMS_HEADER.pack(TERMS_MAGIC, TERMS_VERSION, len(self.offsets) - 1))
+            self.offsets.tofile(f)
+            for part in ['.records', '.strings']:
+                with open(self.file_name + part, 'rb') as p:
+                    shutil.copyfileobj(p, f)
+                os.remove(self.file_name + part)
+
+
+class TermDictionary:
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_terms = TERMS_HEADER.unpack_from(self.buf, 0)
+        if magic != TERMS_MAGIC or version != TERMS_VERSION:
+            raise ValueError(f'{file_name} is not a version {TERMS_VERSION} term dictionary, rebuild the index')
+        records_start = TERMS_HEADER.size + 8 * (self.num_terms + 1)
+        self.offsets = memoryview(self.buf)[TERMS_HEADER.size:records_start].cast('Q')
+        self.records_start = records_start
+        self.strings_start = records_start + TERM_RECORD.size * self.num_terms
+
+    def get_token(self, i):
+        return self.buf[self.strings_start + self.offsets[i]:self.strings_start + self.offsets[i + 1]]
+
+    def find(self, token):
+        token = token.encode('utf-8')
+        low, high = 0, self.num_terms
+        while low < high:
+            mid = (low + high) // 2
+            if self.get_token(mid) < token:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.num_terms and self.get_token(low) == token:
+            return low
+        return None
+
+    def get_record(self, i):
+        record = TERM_RECORD.unpack_from(self.buf, self.records_start + TERM_RECORD.size * i)
+        return record[0], record[1], record[2:8], record[8:14]
+
+    def lookup(self, token):
+        i = self.find(token)
+        if i is None:
+            return None
+        return self.get_record(i)
+
+    def items(self):
+        for i in range(self.num_terms):
+            yield self.get_token(i).decode('utf-8'), self.get_record(i)
+
+
+# Titles are stored as a u64 offset per doc id (plus the end offset) into a blob of concatenated utf-8 titles.
+TITLES_MAGIC = b'WSET'
+TITLES_VERSION = 1
+TITLES_HEADER = struct.Struct('<4sB3xQ')
+
+
+class TitleStoreWriter:
+    def __init__(self, offsets_name, blob_name):
+        self.offsets = open(offsets_name, 'wb')
+        self.offsets.write(TITLES_HEADER.pack(TITLES_MAGIC, TITLES_VERSION, 0))
+        self.blob = open(blob_name, 'wb')
+        self.blob_size = 0
+        self.num_titles = 0
+
+    def add(self, titles):
+        offsets = array('Q')
+        data = []
+        for title in titles:
+            title = title.encode('utf-8')
+            offsets.append(self.blob_size)
+            self.blob_size += len(title)
+            data.append(title)
+        offsets.tofile(self.offsets)
+        self.blob.write(b''.join(data))
+        self.num_titles += len(offsets)
+
+    def close(self):
+        array('Q', [self.blob_size]).tofile(self.offsets)
+        self.offsets.seek(0)
+        self.offsets.write(TITLES_HEADER.pack(TITLES_MAGIC, TITLES_VERSION, self.num_titles))
+        self.offsets.close()
+        self.blob.close()
+
+
+class TitleStore:
+    def __init__(self, offsets_name, blob_name):
+        with open(offsets_name, 'rb') as f:
+            self.offsets_buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_titles = TITLES_HEADER.unpack_from(self.offsets_buf, 0)
+        if magic != TITLES_MAGIC or version != TITLES_VERSION:
+            raise ValueError(f'{offsets_name} is not a version {TITLES_VERSION} title store, rebuild the index')
+        self.offsets = memoryview(self.offsets_buf)[TITLES_HEADER.size:].cast('Q')
+        with open(blob_name, 'rb') as f:
+            # mmap cannot map an empty file
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+
+    def get(self, doc_id):
+        return self.blob[self.offsets[doc_id]:self.offsets[doc_id + 1]].decode('utf-8')
+
+
+# Title prefixes are the normalized titles of an index sorted as utf-8, with their doc ids (relative to the
+# index) and static ranks, followed by the sorted prefixes that more than TITLE_PREFIX_SCAN_LIMIT titles start
+# with and the TITLE_PREFIX_TOP_K best ranked titles of each. Every other prefix has a short range of titles
+# that is ranked when it is looked up. Titles with fewer words rank first, then shorter titles, then by title.
+TITLE_PREFIXES_MAGIC = b'WSEA'
+TITLE_PREFIXES_VERSION = 1
+TITLE_PREFIXES_HEADER = struct.Struct('<4sB3xQQQ')
+TITLE_PREFIX_TOP_K = 10
+TITLE_PREFIX_SCAN_LIMIT = 256
+NO_TITLE = 0xFFFFFFFF
+
+
+def normalize_title(title):
+    return ' '.join(title.lower().split())
+
+
+def normalize_title_prefix(prefix):
+    # a trailing space is kept, so 'new ' completes to 'new york' and not to 'newton'
+    normalized = normalize_title(prefix)
+    return normalized + ' ' if normalized and prefix[-1].isspace() else normalized
+
+
+def get_title_rank_key(title, doc_id):
+    return title.count(b' '), len(title), title, doc_id
+
+
+def get_top_titles(titles, ranks, low, high, depth, prefixes):
+    # titles[low:high] share their first depth bytes. Titles that are exactly the prefix come first, the rest
+    # are split by their next byte, and prefixes of more than TITLE_PREFIX_SCAN_LIMIT titles get their own top k
+    i = low
+    while i < high and len(titles[i]) == depth:
+        i += 1
+    candidates = list(range(low, i))
+    while i < high:
+        j = bisect_left(titles, titles[i][:depth] + bytes([titles[i][depth] + 1]), i, high)
+        if j - i > TITLE_PREFIX_SCAN_LIMIT:
+            candidates.extend(get_top_titles(titles, ranks, i, j, depth + 1, prefixes))
+        else:
+            candidates.extend(range(i, j))
+        i = j
+    top = heapq.nsmallest(TITLE_PREFIX_TOP_K, candidates, key=ranks.__getitem__)
+    prefixes.append((titles[low][:depth], top))
+    return top
+
+
+def write_title_prefixes(file_name, titles):
+    entries = sorted((normalize_title(title).encode('utf-8'), doc_id) for doc_id, title in enumerate(titles))
+    sorted_titles = [title for title, _ in entries]
+    ranks = array('I', bytes(4 * len(entries)))
+    for rank, i in enumerate(sorted(range(len(entries)), key=lambda i: get_title_rank_key(*entries[i]))):
+        ranks[i] = rank
+    prefixes = []
+    if len(entries) > TITLE_PREFIX_SCAN_LIMIT:
+        get_top_titles(sorted_titles, ranks, 0, len(entries), 0, prefixes)
+    prefixes.sort()
+    with open(file_name, 'wb') as f:
+        f.write(TITLE_PREFIXES_HEADER.pack(TITLE_PREFIXES_MAGIC, TITLE_PREFIXES_VERSION, len(entries), len(prefixes),
+                                           TITLE_PREFIX_TOP_K))
+        array('Q', accumulate((len(title) for title in sorted_titles), initial=0)).tofile(f)
+        array('I', [doc_id for _, doc_id in entries]).tofile(f)
+        ranks.tofile(f)
+        array('Q', accumulate((len(prefix) for prefix, _ in prefixes), initial=0)).tofile(f)
+        array('I', [i for _, top in prefixes for i in top + [NO_TITLE] * (TITLE_PREFIX_TOP_K - len(top))]).tofile(f)
+        f.write(b''.join(sorted_titles))
+        f.write(b''.join(prefix for prefix, _ in prefixes))
+
+
+class TitlePrefixes:
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.num_titles, self.num_prefixes, self.top_k = TITLE_PREFIXES_HEADER.unpack_from(self.buf, 0)
+        if magic != TITLE_PREFIXES_MAGIC or version != TITLE_PREFIXES_VERSION:
+            raise ValueError(f'{file_name} is not a version {TITLE_PREFIXES_VERSION} title prefix file, '
+                             'rebuild the index')
+        view = memoryview(self.buf)
+        start = TITLE_PREFIXES_HEADER.size
+        sections = []
+        for size, item_format in [(self.num_titles + 1, 'Q'), (self.num_titles, 'I'), (self.num_titles, 'I'),
+                                  (self.num_prefixes + 1, 'Q'), (self.num_prefixes * self.top_k, 'I')]:
+            end = start + size * array(item_format).itemsize
+            sections.append(view[start:end].cast(item_format))
+            start = end
+        self.title_offsets, self.doc_ids, self.ranks, self.prefix_offsets, self.top_titles = sections
+        self.titles_start = start
+        self.prefixes_start = start + self.title_offsets[self.num_titles]
+
+    def get_title(self, i):
+        return self.buf[self.titles_start + self.title_offsets[i]:self.titles_start + self.title_offsets[i + 1]]
+
+    def get_prefix(self, i):
+        return self.buf[self.prefixes_start + self.prefix_offsets[i]:self.prefixes_start + self.prefix_offsets[i + 1]]
+
+    def find_prefix(self, prefix):
+        low, high = 0, self.num_prefixes
+        while low < high:
+            mid = (low + high) // 2
+            if self.get_prefix(mid) < prefix:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.num_prefixes and self.get_prefix(low) == prefix:
+            return low
+        return None
+
+    def find_title(self, title):
+        low, high = 0, self.num_titles
+        while low < high:
+            mid = (low + high) // 2
+            if self.get_title(mid) < title:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def complete(self, prefix, num_results, tombstones=None):
+        # the best ranked titles starting with prefix as (doc id, title) pairs, without deleted doc ids
+        prefix = normalize_title_prefix(prefix).encode('utf-8')
+        num_results = min(num_results, self.top_k)
+        if num_results <= 0:
+            return []
+        j = self.find_prefix(prefix)
+        top = None
+        if j is not None:
+            top = [i for i in self.top_titles[j * self.top_k:(j + 1) * self.top_k]
+                   if i != NO_TITLE and not is_deleted(tombstones, self.doc_ids[i])]
+        if top is None or len(top) < num_results:
+            # a short range, or a long one whose stored top k lost too many titles to deletions
+            # (no utf-8 byte is 0xff, so every title starting with prefix sorts before prefix + 0xff)
+            titles = range(self.find_title(prefix), self.find_title(prefix + b'\xff'))
+            top = heapq.nsmallest(num_results, (i for i in titles if not is_deleted(tombstones, self.doc_ids[i])),
+                                  key=self.ranks.__getitem__)
+        return [(self.doc_ids[i], self.get_title(i).decode('utf-8')) for i in top[:num_results]]
+
+
+# segments.txt lists the live segments of an index, one "directory base_doc_id num_pages" line each, directories
+# relative to the index root. Doc ids are global, a segment holds base_doc_id to base_doc_id + num_pages - 1.
+# shards.txt lists the doc id ranges of a sharded index in the same format.
+# retired_segments.txt lists the segments a compaction replaced that are not deleted yet. Searchers hold a shared
+# flock on segment.lock in every segment they read, compaction only deletes a retired segment it can lock exclusively.
+SEGMENTS_FILE = 'segments.txt'
+SHARDS_FILE = 'shards.txt'
+RETIRED_SEGMENTS_FILE = 'retired_segments.txt'
+SEGMENT_LOCK_FILE = 'segment.lock'
+TOMBSTONES_FILE = 'tombstones.bin'
+
+
+def read_segments(index_root, file_name=SEGMENTS_FILE):
+    if not os.path.exists(index_root + file_name):
+        return None
+    segments = []
+    with open(index_root + file_name, 'r', encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                name, base, num_pages = line.split()
+                segments.append((name, int(base), int(num_pages)))
+    return segments
+
+
+def write_segments(index_root, segments, file_name=SEGMENTS_FILE):
+    # readers only ever see a complete list
+    with open(index_root + file_name + '.tmp', 'w', encoding="utf-8") as f:
+        for name, base, num_pages in segments:
+            f.write(f'{name} {base} {num_pages}\n')
+    os.replace(index_root + file_name + '.tmp', index_root + file_name)
+
+
+def read_tombstones(segment_dir):
+    # bit i of the bitmap is set when the segment's i-th page was deleted or replaced by a later segment
+    if not os.path.exists(segment_dir + TOMBSTONES_FILE):
+        return None
+    with open(segment_dir + TOMBSTONES_FILE, 'rb') as f:
+        return bytearray(f.read())
+
+
+def write_tombstones(segment_dir, tombstones):
+    with open(segment_dir + TOMBSTONES_FILE + '.tmp', 'wb') as f:
+        f.write(tombstones)
+    os.replace(segment_dir + TOMBSTONES_FILE + '.tmp', segment_dir + TOMBSTONES_FILE)
+
+
+# manifest.json describes an index directory in one small file: its format, page and token counts and the
+# settings its text was preprocessed with, so a searcher can start from it alone.
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+def write_manifest(index_dir, manifest):
+    with open(index_dir + MANIFEST_FILE + '.tmp', 'w', encoding="utf-8") as f:
+        json.dump(dict(manifest, version=MANIFEST_VERSION), f, indent=2)
+    os.replace(index_dir + MANIFEST_FILE + '.tmp', index_dir + MANIFEST_FILE)
+
+
+def read_manifest(index_dir):
+    # None for indexes built before manifests were written
+    if not os.path.exists(index_dir + MANIFEST_FILE):
+        return None
+    with open(index_dir + MANIFEST_FILE, 'r', encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'{index_dir}{MANIFEST_FILE} is not a version {MANIFEST_VERSION} manifest, rebuild the index')
+    return manifest
+
+
+def is_deleted(tombstones, page_num):
+    return tombstones is not None and tombstones[page_num >> 3] >> (page_num & 7) & 1
+
+
+def parse_size(size):
+    # 2G, 512M, 64K or a number of bytes, for the memory budgets and cache sizes on the command line
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
@@ -0,0 +1,21 @@
+import importlib
+import importlib.util
+
+
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+def lazy_import(name):
+    # a module that is imported on first use, or None when it is not installed. numpy takes longer to import than
+    # the rest of the searcher, and most searches never touch it
+    if importlib.util.find_spec(name) is None:
+        return None
+    return LazyModule(name)
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+# Cumulative per-stage timers and event counters for the indexer and the searcher. A disabled registry hands out
+# a shared no-op context manager, so instrumented code pays one method call per stage.
+null_timer = nullcontext()
+
+
+class Timer():
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+
+class TimedReader():
+    def __init__(self, f, name, metrics):
+        self.f = f
+        self.name = name
+        self.metrics = metrics
+
+    def read(self, size=-1):
+        with self.metrics.timer(self.name):
+            return self.f.read(size)
+
+    def close(self):
+        self.f.close()
+
+
+class Metrics():
+    def __init__(self):
+        self.enabled = False
+        self.exporter = None
+        self.stop_event = None
+        self.reset()
+
+    def reset(self):
+        # forked workers call this first, they inherit the parent's totals and maybe a held lock
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def timer(self, name):
+        if not self.enabled:
+            return null_timer
+        return Timer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += calls
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'timers': {name: {'seconds': seconds, 'calls': self.calls[name]}
+                           for name, seconds in sorted(self.seconds.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def take(self):
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        for name, timer in snapshot['timers'].items():
+            self.add_time(name, timer['seconds'], timer['calls'])
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] += value
+
+    def get_stage_seconds(self, before):
+        timers = self.snapshot()['timers']
+        stages = {}
+        for name, timer in timers.items():
+            seconds = timer['seconds'] - before['timers'].get(name, {'seconds': 0.0})['seconds']
+            if seconds > 0:
+                stages[name] = seconds
+        return stages
+
+    def to_prometheus(self, snapshot):
+        lines = ['# TYPE wiki_stage_seconds_total counter']
+        lines += [f'wiki_stage_seconds_total{{stage="{name}"}} {timer["seconds"]}'
+                  for name, timer in snapshot['timers'].items()]
+        lines.append('# TYPE wiki_stage_calls_total counter')
+        lines += [f'wiki_stage_calls_total{{stage="{name}"}} {timer["calls"]}'
+                  for name, timer in snapshot['timers'].items()]
+        lines.append('# TYPE wiki_events_total counter')
+        lines += [f'wiki_events_total{{event="{name}"}} {value}' for name, value in snapshot['counters'].items()]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_name, file_format='json'):
+        snapshot = self.snapshot()
+        snapshot['time'] = time.time()
+        # scrapers only ever see a complete file
+        with open(file_name + '.tmp', 'w', encoding="utf-8") as f:
+            if file_format == 'prometheus':
+                f.write(self.to_prometheus(snapshot))
+            else:
+                json.dump(snapshot, f, indent=2)
+        os.replace(file_name + '.tmp', file_name)
+
+    def start_exporter(self, file_name, file_format='json', interval=10.0):
+        self.enabled = True
+        self.stop_event = threading.Event()
+
+        def export():
+            while not self.stop_event.wait(interval):
+                self.write(file_name, file_format)
+            self.write(file_name, file_format)
+
+        self.exporter = threading.Thread(target=export, daemon=True)
+        self.exporter.start()
+
+    def stop_exporter(self):
+        if self.exporter is not None:
+            self.stop_event.set()
+            self.exporter.join()
+            self.exporter = None
+
+
+metrics = Metrics()
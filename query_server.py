@@ -0,0 +1,149 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from metrics import metrics
+
+server_run_query = None
+
+
+def init_server_worker(make_run_query):
+    global server_run_query
+    # ctrl-c reaches the whole process group, only the event loop process shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    metrics.reset()
+    server_run_query = make_run_query()
+
+
+def get_cache_stats(run_query):
+    stats = {}
+    if run_query.result_cache is not None:
+        stats['result_cache'] = run_query.result_cache.get_stats()
+    if run_query.query_results is not None and run_query.query_results.postings_cache is not None:
+        stats['postings_cache'] = run_query.query_results.postings_cache.get_stats()
+    return stats
+
+
+def run_server_task(path, query, num_results):
+    s = time.time()
+    if path == '/complete':
+        results = [{'id': id, 'title': title} for id, title in server_run_query.complete(query, num_results)]
+        result = {'prefix': query, 'results': results, 'time': time.time() - s}
+    else:
+        results = server_run_query.search(query, num_results)
+        results = [{'id': id, 'title': server_run_query.get_title(id), 'score': score} for id, score in results]
+        result = {'query': query, 'results': results, 'time': time.time() - s}
+    # cache statistics and timings of the worker travel back with the result
+    return (result, os.getpid(), get_cache_stats(server_run_query),
+            metrics.take() if metrics.enabled else None)
+
+
+class QueryServer:
+    def __init__(self, make_run_query, num_workers, max_in_flight):
+        # ranking is pure python and holds the GIL, so queries are ranked in forked worker processes. They share
+        # the mmapped index files and each keeps its own RunQuery and copies of the caches
+        self.executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('fork'),
+                                            initializer=init_server_worker, initargs=(make_run_query,))
+        # with fork every worker is started on the first task, before the event loop runs
+        self.executor.submit(os.getpid).result()
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.num_served = 0
+        self.num_rejected = 0
+        self.worker_stats = {}
+
+    def get_stats(self):
+        stats = {'in_flight': self.in_flight, 'served': self.num_served, 'rejected': self.num_rejected}
+        # as of the last query each worker answered
+        stats['workers'] = [{'pid': pid, **worker_stats} for pid, worker_stats in sorted(self.worker_stats.items())]
+        return stats
+
+    async def handle_request(self, method, target):
+        if method != 'GET':
+            return 405, {'error': 'only GET is supported'}
+        url = urlsplit(target)
+        loop = asyncio.get_running_loop()
+        if url.path == '/stats':
+            return 200, self.get_stats()
+        if url.path not in ('/search', '/complete'):
+            return 404, {'error': f'unknown path {url.path}'}
+        # an empty prefix completes to the best ranked titles, and completions keep their trailing space
+        params = parse_qs(url.query, keep_blank_values=url.path == '/complete')
+        if 'q' not in params:
+            return 400, {'error': 'missing q parameter'}
+        try:
+            num_results = int(params.get('k', ['10'])[0])
+        except ValueError:
+            return 400, {'error': 'k must be an integer'}
+        if self.in_flight >= self.max_in_flight:
+            # shed load instead of queueing without bound, clients retry later
+            self.num_rejected += 1
+            return 503, {'error': 'too many queries in flight'}
+        self.in_flight += 1
+        query = params['q'][0] if url.path == '/complete' else params['q'][0].strip()
+        try:
+            result, pid, worker_stats, worker_metrics = await loop.run_in_executor(
+                self.executor, run_server_task, url.path, query, num_results)
+        except Exception as e:
+            return 500, {'error': repr(e)}
+        finally:
+            self.in_flight -= 1
+        self.worker_stats[pid] = worker_stats
+        if worker_metrics is not None:
+            metrics.merge(worker_metrics)
+        self.num_served += 1
+        return 200, result
+
+    async def handle_client(self, reader, writer):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                   500: 'Internal Server Error', 503: 'Service Unavailable'}
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = request_line.rstrip().endswith(b'HTTP/1.1')
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    if header.lower().startswith(b'connection:'):
+                        keep_alive = header.split(b':', 1)[1].strip().lower() == b'keep-alive'
+                try:
+                    method, target, _ = request_line.decode('latin-1').split()
+                except ValueError:
+                    status, body, keep_alive = 400, {'error': 'malformed request line'}, False
+                else:
+                    status, body = await self.handle_request(method, target)
+                body = json.dumps(body).encode('utf-8')
+                headers = [f'HTTP/1.1 {status} {reasons[status]}', 'Content-Type: application/json',
+                           f'Content-Length: {len(body)}', 'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+                if status == 503:
+                    headers.append('Retry-After: 1')
+                writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, host, port):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f'Serving on http://{host}:{port}/search?q=...')
+        async with server:
+            await server.serve_forever()
+
+    def serve(self, host, port):
+        try:
+            asyncio.run(self.run(host, port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown()
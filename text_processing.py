@@ -0,0 +1,57 @@
+import re
+
+from metrics import metrics
+
+# bytes.translate table that keeps ascii letters and digits and turns every other byte into a space
+token_bytes = bytes(c if chr(c).isalnum() and c < 128 else 32 for c in range(256))
+html_tags = re.compile('&amp;|&apos;|&gt;|&lt;|&nbsp;|&quot;')
+# the snowball stemmer and the nltk stop word list of this language
+stemmer_language = 'english'
+
+
+# https://medium.com/analytics-vidhya/search-engine-in-python-from-scratch-c3f7cc453250
+class TextPreProcessor:
+    def __init__(self, html_tags, stemmer, stop_words, stem_cache_size=1 << 17):
+        self.html_tags = html_tags
+        self.stemmer = stemmer
+        self.stop_words = stop_words
+        # newlines used to be replaced by spaces before these ran, hence [^ \n] and . matching newlines
+        self.http_urls = re.compile('http://[^ \n]+')
+        self.https_urls = re.compile('https://[^ \n]+')
+        self.markup = re.compile(r'\{.*?\}|\[.*?\]|==.*?==', re.S)
+        # stems keyed by surface form, None for stop words. The vocabulary is Zipfian, so most tokens of a page
+        # were seen before
+        self.stem_cache = {}
+        self.stem_cache_size = stem_cache_size
+
+    def remove_html_tags(self, text_data):
+        cleaned_text = self.html_tags.sub(' ', text_data)
+        return cleaned_text
+
+    def tokenize_sentence(self, text_data, flag=False):
+        if flag:
+            text_data = text_data.replace('File:', ' ')
+            text_data = self.http_urls.sub(' ', text_data)
+            text_data = self.https_urls.sub(' ', text_data)
+            text_data = self.markup.sub(' ', text_data)
+        cleaned_text = self.remove_html_tags(text_data)
+        # non-ascii characters and everything but letters and digits split tokens
+        return cleaned_text.encode('utf-8').translate(token_bytes).decode('ascii').split()
+
+    def stem_tokens(self, tokens):
+        stem_cache = self.stem_cache
+        missing = {token for token in tokens if token not in stem_cache}
+        if missing:
+            if len(stem_cache) + len(missing) > self.stem_cache_size:
+                stem_cache.clear()
+                missing = set(tokens)
+            missing = list(missing)
+            for token, stem in zip(missing, self.stemmer.stemWords(missing)):
+                stem_cache[token] = None if token in self.stop_words else stem
+        return [stem for stem in map(stem_cache.__getitem__, tokens) if stem is not None]
+
+    def preprocess_text(self, text_data, flag=False):
+        with metrics.timer('text.preprocess'):
+            cleaned_data = self.tokenize_sentence(text_data.lower(), flag)
+            cleaned_data = self.stem_tokens(cleaned_data)
+        return cleaned_data